@@ -1,11 +1,12 @@
 import os
-import copy
+import time
 import random
 import numpy as np
 import torch
-from torch.autograd import Variable
 import torch.nn.functional as F
-from utils.util import norm_image
+from utils.util import norm_image, amp_autocast
+from models import unwrap_model
+from planner import PlannerEngine
 
 
 class ActionSampleManager:
@@ -13,14 +14,24 @@ class ActionSampleManager:
         self.args = args
         self.prev_act = np.array([1.0, 0.0])
         self.guides = guides
-        self.cand_num = 20
-        self.top_k = 5
+        self.cand_num = args.cand_num
+        # candidates kept after the first stage of SAS, the chosen one is the one of least instance-collision cost
+        self.top_k = args.SAS_thred
+        # share of the candidates drawn around the warm-start plan (--warm-start)
+        self.warm_ratio = 0.5
+        # the action sequence chosen on the last step, None when there is nothing to warm start from
+        self.plan = None
         self.p = None
         self.pstep = self.args.pred_step
+        self.seed = args.sample_seed if args.sample_seed is not None else np.random.randint(2**31-1)
+        self.rng = np.random.default_rng(self.seed)
+        self.generators = dict()
         self.time_discount = 0.5**torch.range(0, self.pstep-1)
         self.time_discount = torch.clamp(self.time_discount, 1/8., 1.)
-        if torch.cuda.is_available():
-            self.time_discount = self.time_discount.cuda()
+        self.time_discount = self.time_discount.to(args.device)
+        self.planner = planners[args.planner](self)
+        # rounds, candidates evaluated and latency (ms) of the last planned step
+        self.plan_stats = dict()
 
     def get_guide_action(self, action, lb=-1.0, ub=1.0):
         # get the index of target bin in guidance grid
@@ -31,29 +42,38 @@ class ActionSampleManager:
         weight = np.array(weight)
         return np.sum(action * weight, axis=-1)
   
-    def generate_episode(self, mean, lb=-1.0, ub=1.0):
-        res = []
-        semi_range = (ub - lb) / 2.0
-        uni_sample = lambda x: np.random.uniform(low=-semi_range/x, high=semi_range/x)
-        for i in range(self.args.pred_step):
-            rand = list(map(uni_sample, self.args.bin_divide))
-            res.append(np.array(mean + rand))
-        res = list(map(lambda x: x.reshape(1, -1), res))
-        return np.concatenate(res, axis=0)
-
-    def generate_action(self, p, size, guides, lb=-1.0, ub=1.0):
-        res = []
-        for _ in range(size):
-            c = np.random.choice(range(len(p)), p=p)
-            res.append(np.expand_dims(self.generate_episode(guides[c], lb, ub), axis=0))
-        return np.concatenate(res, axis=0)
+    def generate_action(self, p, size, guides, lb=-1.0, ub=1.0, device=None):
+        # draw size candidate sequences at once: a guide bin per candidate from p, and uniform noise
+        # within half a bin width around the bin center for every predicted step and action dim
+        # with a device, the candidates are drawn by torch and returned as a tensor on that device
+        dim = len(self.args.bin_divide)
+        semi_range = (ub - lb) / 2.0 / np.array(self.args.bin_divide)
+        if device is None:
+            c = self.rng.choice(len(p), size=size, p=p)
+            noise = self.rng.uniform(-1.0, 1.0, size=(size, self.pstep, dim)) * semi_range
+            return guides[c][:, np.newaxis, :] + noise
+
+        generator = self._generator(device)
+        c = torch.multinomial(torch.from_numpy(p).float().to(device), size, replacement=True, generator=generator)
+        noise = torch.rand(size, self.pstep, dim, generator=generator, device=device) * 2 - 1
+        noise = noise * torch.from_numpy(semi_range).float().to(device)
+        return torch.from_numpy(guides).float().to(device)[c].unsqueeze(1) + noise
+
+    def _generator(self, device):
+        device = torch.device(device)
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].manual_seed(self.seed)
+        return self.generators[device]
 
     def add_cost(self, output, key, speeds, weight, with_cur=False):
         pred = output[key]
         # with_cur indicates whether the prediction contains that on the current frame
         if with_cur:
             pred = pred[:, 1:]
-        pred = F.softmax(pred, -1) # predicts binary events
+        # costs are computed in FP32, the predictions may be half precision under --amp
+        pred = F.softmax(pred.float(), -1) # predicts binary events
+        speeds = speeds.float()
         
         # calculate cost value for one cost item
         to_round = (self.args.sample_type == 'binary')
@@ -67,28 +87,57 @@ class ActionSampleManager:
             pred_neg = torch.round(pred[:, :, 1]) if to_round else pred[:, :, 1]
 
         cost = -pred_pos * speeds + pred_neg * self.args.speed_threshold
-        cost = cost * self.time_discount
         if key == "colls_with_prob":
             cost = cost.sum(axis=2)
+        cost = cost * self.time_discount
         cost = (cost.view(-1, self.args.pred_step, 1) * weight).sum(-1).sum(-1)
         return cost
 
-    def estimate_cost(self, net, imgs, actions, action_var=None, hidden=None, cell=None):
-        batch_size = int(imgs.size()[0])
+    def step_cost(self, pred, speed):
+        # the cost add_cost gives one frame event on one predicted step before discounting, pred: N x 2 logits
+        pred = F.softmax(pred.float(), -1)
+        to_round = (self.args.sample_type == 'binary')
+        pred_pos = torch.round(pred[:, 0]) if to_round else pred[:, 0]
+        pred_neg = torch.round(pred[:, 1]) if to_round else pred[:, 1]
+        return -pred_pos * speed + pred_neg * self.args.speed_threshold
+
+    def cost_outputs(self):
+        # the model outputs estimate_cost reads, the other heads are skipped during planning
+        outputs = {'speed'}
+        use_coll = (self.args.sample_with_collision and self.args.use_collision)
+        if use_coll: outputs.add('coll_prob')
+        if self.args.sample_with_offroad and self.args.use_offroad: outputs.add('offroad_prob')
+        if self.args.sample_with_offlane and self.args.use_offlane: outputs.add('offlane_prob')
+        # the instance-collision heads run on the rollout only with --batch-heads, see estimate_cost_steps
+        if self.instance_cost() and self.args.batch_heads: outputs.add('colls_with_prob')
+        return outputs
 
-        weight = (self.args.time_decay ** np.arange(self.args.pred_step)).reshape((1, self.args.pred_step, 1))
-        weight = Variable(torch.from_numpy(weight).float().cuda()).repeat(batch_size, 1, 1)
+    def instance_cost(self):
+        # whether the top_k candidates are told apart by their instance-collision cost (SAS)
+        return self.args.sample_with_collision and self.args.use_collision and self.args.use_colls_with and self.args.SAS
 
-        output = net(imgs, actions, hidden=hidden, cell=cell, training=False, action_var=action_var)
+    def estimate_cost(self, net, history, actions):
+        # net is the unwrapped ConvLSTMMulti, history its encoding of the current observation,
+        # or a PlannerEngine running the exported rollout and cost graph
+        if isinstance(net, PlannerEngine):
+            return net.estimate_cost(history, actions)
+        batch_size = int(actions.size()[0])
+        if (self.args.prune_rollout or self.instance_cost()) and not self.args.batch_heads:
+            return self.estimate_cost_steps(net, history, actions)
 
-        cost = 0
-        speeds = output['speed'].view(-1, self.args.pred_step)
+        weight = (self.args.time_decay ** np.arange(self.args.pred_step)).reshape((1, self.args.pred_step, 1))
+        weight = torch.from_numpy(weight).float().to(actions.device).repeat(batch_size, 1, 1)
 
         use_coll = (self.args.sample_with_collision and self.args.use_collision)
         use_ins_coll = (use_coll and self.args.use_colls_with)
         use_offroad = (self.args.sample_with_offroad and self.args.use_offroad)
         use_offlane = (self.args.sample_with_offlane and self.args.use_offlane)
 
+        output = net.rollout(history, actions, training=False, outputs=self.cost_outputs())
+
+        cost = 0
+        speeds = output['speed'].view(-1, self.args.pred_step)
+
         if use_coll: cost += self.add_cost(output, 'coll_prob', speeds, weight)
         # if use_ins_coll: cost += self.add_cost(output, 'colls_with_prob', speeds, weight, with_cur=True)
         if use_offroad: cost += self.add_cost(output, 'offroad_prob', speeds, weight)
@@ -96,56 +145,145 @@ class ActionSampleManager:
         if use_ins_coll and self.args.SAS: 
             ins_cos = self.add_cost(output, 'colls_with_prob', speeds, weight, with_cur=True)
         else:
-            ins_cos = 0
+            ins_cos = torch.zeros(batch_size, device=actions.device)
 
         return cost, ins_cos
 
-    def _sample_action(self, p, net, imgs, guides, action_var=None, testing=False):
-        imgs = copy.deepcopy(imgs)
-        imgs = norm_image(imgs)
+    def estimate_cost_steps(self, net, history, actions):
+        '''
+        estimate_cost rolling the candidates out one step at a time, in two stages. Stage one rolls out the
+        scene-level costs (the frame events and speed). With --prune-rollout it is a branch-and-bound rollout: after
+        each step, a candidate whose cost so far plus the least the remaining steps can add is above the top_k-th
+        lowest cost so far plus the most they can add cannot make the top_k any more; its rollout stops there and its
+        cost is inf. An event term of a step costs between -speed and speed_threshold, times the step's time discount
+        and decay; the predicted speeds are then clamped to [0, --prune-speed-limit] so that these bounds hold, and
+        the top_k are those of the full rollout with the clamped speeds. Stage two (SAS) runs the instance-collision
+        head on the predicted feature maps of the top_k candidates only, kept from stage one; the others get an
+        instance-collision cost of inf. The heads of --batch-heads only run after the whole rollout, it needs estimate_cost.
+        '''
+        batch_size, device = actions.size(0), actions.device
+        outputs = self.cost_outputs()
+        keys = [key for key in ['coll_prob', 'offroad_prob', 'offlane_prob'] if key in outputs]
+        prune, limit = self.args.prune_rollout, self.args.prune_speed_limit
+        discount = self.time_discount * self.args.time_decay ** torch.arange(self.pstep, device=device).float()
+        # the discounts of the steps after each step
+        remaining = discount.flip(0).cumsum(0).flip(0) - discount
+        lower, upper = -len(keys) * limit * remaining, len(keys) * self.args.speed_threshold * remaining
 
-        batch_size, c, w, h = int(imgs.size()[0]), int(imgs.size()[-3]), int(imgs.size()[-2]), int(imgs.size()[-1])
-        imgs = imgs.view(batch_size, 1, c, w, h)
+        alive = torch.arange(batch_size, device=device)
+        partial = torch.zeros(batch_size, device=device)
+        step_state = net.rollout_start(history, batch_size)
+        # the predicted feature maps and speeds of the candidates alive, per step, for stage two
+        cache = []
+        candidate_steps = 0
+        for t in range(self.pstep):
+            output, step_state = net.rollout_step(step_state, actions[alive, t], outputs=outputs)
+            candidate_steps += alive.numel()
+            speed = output['speed'].view(-1).float()
+            if prune:
+                speed = speed.clamp(0, limit)
+            for key in keys:
+                partial = partial + self.step_cost(output[key], speed) * discount[t]
+            if self.instance_cost():
+                cache.append((step_state[0][-1], speed))
+            if not prune or t == self.pstep - 1 or alive.numel() <= self.top_k:
+                continue
+            bound = torch.kthvalue(partial + upper[t], self.top_k).values
+            keep = (partial + lower[t] <= bound).nonzero().view(-1)
+            if keep.numel() < alive.numel():
+                step_state, cache = net.rollout_take((step_state, cache), keep, alive.numel())
+                alive, partial = alive[keep], partial[keep]
 
-        imgs = imgs.repeat(self.cand_num, 1, 1, 1, 1)
-        action_var = action_var.repeat(self.cand_num, 1, 1)
-        
-        # generate action candidates from guidances
-        action = self.generate_action(p, self.cand_num, guides)
+        self.plan_stats['plan_candidate_steps'] = self.plan_stats.get('plan_candidate_steps', 0) + candidate_steps
+        cost = torch.full((batch_size,), float('inf'), device=device)
+        cost[alive] = partial
+        if not self.instance_cost():
+            return cost, torch.zeros(batch_size, device=device)
 
-        this_action0 = copy.deepcopy(action)
-        this_action = Variable(torch.from_numpy(action).cuda().float(), requires_grad=False)
-        with torch.no_grad():
-            cost, ins_cost = self.estimate_cost(net, imgs, this_action, action_var, None, None).data.cpu().numpy()
-        
+        # stage two: the detector once over the top_k candidates' predicted steps, stacked candidate-major
+        top_k = torch.topk(partial, min(self.top_k, alive.numel()), largest=False)[1]
+        cache = net.rollout_take(cache, top_k, alive.numel())
+        fms = [torch.stack(level, dim=1).flatten(0, 1) for level in zip(*[fms for fms, _ in cache])]
+        preds = net.conv_lstm.detect(fms, net.conv_lstm.detection_outputs, {'colls_with_prob'})
+        output = {'colls_with_prob': preds['colls_with_prob'].view(top_k.numel(), self.pstep, *preds['colls_with_prob'].shape[1:])}
+        speeds = torch.stack([speed for _, speed in cache], dim=1)
+        weight = (self.args.time_decay ** torch.arange(self.pstep, device=device).float()).view(1, -1, 1)
+        ins_cost = torch.full((batch_size,), float('inf'), device=device)
+        ins_cost[alive[top_k]] = self.add_cost(output, 'colls_with_prob', speeds, weight)
+        return cost, ins_cost
+
+    def select(self, cost, ins_cost):
+        # index of the chosen candidate: the lowest instance-collision cost among the top_k by cost
         idx = np.argpartition(cost, self.top_k)
         top_k_idx = idx[:self.top_k]
         top_k_ins_cost = ins_cost[top_k_idx]
         idx = np.argmin(top_k_ins_cost)
-        true_idx = top_k_idx[idx]
-        res = this_action0[true_idx, :, :]
-        
+        return top_k_idx[idx]
+
+    def warm_candidates(self, size, device, lb=-1.0, ub=1.0):
+        # receding horizon: the last plan shifted by one step (its last action repeated) and size-1 candidates
+        # around it, with the same noise as generate_action
+        plan = np.concatenate([self.plan[1:], self.plan[-1:]])
+        semi_range = (ub - lb) / 2.0 / np.array(self.args.bin_divide)
+        if self.args.sample_on_device:
+            noise = torch.rand(size, *plan.shape, generator=self._generator(device), device=device) * 2 - 1
+            noise = noise * torch.from_numpy(semi_range).float().to(device)
+        else:
+            noise = torch.from_numpy(self.rng.uniform(-1.0, 1.0, size=(size,) + plan.shape) * semi_range).float().to(device)
+        noise[0] = 0
+        return torch.clamp(torch.from_numpy(plan).float().to(device) + noise, lb, ub)
+
+    def draw_candidates(self, p, guides, device):
+        # the first round of every planner: cand_num candidates around the guide bins drawn from p,
+        # with --warm-start a warm_ratio share of them around the plan of the last step instead
+        num_warm = int(self.cand_num * self.warm_ratio) if self.args.warm_start and self.plan is not None else 0
+        if self.args.sample_on_device:
+            actions = self.generate_action(p, self.cand_num - num_warm, guides, device=device)
+        else:
+            actions = torch.from_numpy(self.generate_action(p, self.cand_num - num_warm, guides)).float().to(device)
+        if num_warm > 0:
+            actions = torch.cat([self.warm_candidates(num_warm, device), actions])
+        return actions
+
+    def _sample_action(self, p, net, history, guides, testing=False, deadline=None):
+        # net is the unwrapped ConvLSTMMulti, history its encoding of the current observation
+        device = next(net.parameters()).device
+        res, rounds, evaluated = self.planner.plan(net, history, p, guides, device, deadline)
+        self.plan = res
+        self.plan_stats['plan_rounds'] = rounds
+        self.plan_stats['plan_candidates'] = evaluated
+
         if not testing:
             return res[0]
         else:
             return res
 
-    def sample_action(self, net, obs, obs_var, action_var, exploration, step, explore=False, testing=False):
+    def sample_action(self, net, obs, obs_var, action_var, exploration, step, explore=False, testing=False, feature_cache=None):
+        start = time.time()
+        self.plan_stats = dict()
         if random.random() <= 1 - exploration.value(step) or not explore:
-            obs = torch.from_numpy(np.expand_dims(obs.transpose(2, 0, 1), axis=0).copy()).float()
-            obs = norm_image(obs)
-
-            if torch.cuda.is_available():
-                obs = obs.cuda()
-            with torch.no_grad():
-                obs = obs.repeat(max(1, torch.cuda.device_count()), 1, 1, 1)
-                self.p = net(obs, action_only=True)[0]
-                p = F.softmax(self.p / self.args.temperature, dim=-1).data.cpu().numpy()
-            
-            action = self._sample_action(p, net, obs_var, self.guides, action_var=action_var, testing=testing)
+            # obs is the latest frame of obs_var: a single backbone pass over the history
+            # gives both the guidance distribution and the features for planning
+            net = unwrap_model(net)
+            device = next(net.parameters()).device
+            imgs = norm_image(obs_var.to(device))
+            imgs = imgs.view(imgs.size(0), 1, *imgs.size()[-3:])
+            # with --amp the encoding and the rollouts run under autocast, the exported graphs of a PlannerEngine in FP32
+            with amp_autocast(self.args, enabled=not isinstance(net, PlannerEngine)):
+                with torch.no_grad():
+                    history, logit = net.encode(imgs, action_var.to(device), feature_cache=feature_cache, with_guide=True, outputs=self.cost_outputs())
+                    self.p = logit[0].float()
+                    p = F.softmax(self.p / self.args.temperature, dim=-1).data.cpu().numpy()
+
+                # the budget covers the whole step, encoding included
+                deadline = start + self.args.plan_budget / 1000.0 if self.args.plan_budget > 0 else None
+                action = self._sample_action(p, net, history, self.guides, testing=testing, deadline=deadline)
+            self.plan_stats['plan_latency'] = (time.time() - start) * 1000
         else:
             p = None
             action = np.random.rand(self.args.num_total_act) * 2 - 1
+            # the executed action left the plan
+            self.plan = None
         action = np.clip(action, -1, 1)
         guide_act = self.get_guide_action(action)
 
@@ -158,3 +296,96 @@ class ActionSampleManager:
 
     def reset(self):
         self.prev_act = np.array([1.0, 0.0])
+        self.plan = None
+
+
+class ShootingPlanner:
+    '''
+    Random shooting, the original SPC planner: one round of cand_num candidates drawn around the guide bins,
+    the chosen one is picked by ActionSampleManager.select among them.
+    '''
+    def __init__(self, manager):
+        self.manager = manager
+        self.args = manager.args
+
+    def plan(self, net, history, p, guides, device, deadline=None):
+        # returns the chosen action sequence (pred_step x num_total_act), the rounds run and the candidates evaluated
+        actions = self.manager.draw_candidates(p, guides, device)
+        cost, ins_cost = self.evaluate(net, history, actions)
+        return self.choose([actions], [cost], [ins_cost]), 1, actions.size(0)
+
+    def evaluate(self, net, history, actions):
+        with torch.no_grad():
+            # the history frames are encoded once and shared by all candidates,
+            # only the LSTM rollout and the event heads run per candidate
+            return self.manager.estimate_cost(net, history, actions)
+
+    def choose(self, pool, pool_cost, pool_ins_cost):
+        # the chosen one among all candidates evaluated (lists of the rounds' candidates and costs)
+        pool = torch.cat(pool)
+        idx = self.manager.select(torch.cat(pool_cost).cpu().numpy(), torch.cat(pool_ins_cost).cpu().numpy())
+        return pool[idx].cpu().numpy().astype(np.float64)
+
+
+class IterativePlanner(ShootingPlanner):
+    '''
+    A planner of up to --plan-rounds rounds: the first round is that of ShootingPlanner, the next ones are
+    drawn by refine (defined by the subclasses) from the costs of the last one, and the chosen candidate is
+    picked among all candidates evaluated. With --plan-budget, another round only starts if it is expected
+    (as long as the last one) to end before the deadline; the first round always runs, so a step takes at
+    least one rollout of cand_num candidates.
+    '''
+    min_std = 0.05
+
+    def __init__(self, manager):
+        super(IterativePlanner, self).__init__(manager)
+        self.max_rounds = self.args.plan_rounds
+
+    def plan(self, net, history, p, guides, device, deadline=None):
+        actions = self.manager.draw_candidates(p, guides, device)
+        # every candidate evaluated so far, the final pick is made among them
+        pool, pool_cost, pool_ins_cost = [], [], []
+        while True:
+            round_start = time.time()
+            cost, ins_cost = self.evaluate(net, history, actions)
+            pool.append(actions)
+            pool_cost.append(cost)
+            pool_ins_cost.append(ins_cost)
+
+            now = time.time()
+            if len(pool) >= self.max_rounds or (deadline is not None and now + (now - round_start) > deadline):
+                break
+            actions = self.refine(actions, cost)
+        return self.choose(pool, pool_cost, pool_ins_cost), len(pool), sum(actions.size(0) for actions in pool)
+
+    def gaussian(self, mean, std):
+        # cand_num candidates from a per step / action dim gaussian, clipped to the action range
+        generator = self.manager._generator(mean.device)
+        noise = torch.randn(self.manager.cand_num, *mean.size(), generator=generator, device=mean.device)
+        return torch.clamp(mean + std * noise, -1.0, 1.0)
+
+
+class CEMPlanner(IterativePlanner):
+    # cross-entropy method: the next round is drawn from a gaussian fitted to the top_k candidates of the last one
+    def refine(self, actions, cost):
+        elites = actions[torch.topk(cost, self.manager.top_k, largest=False)[1]]
+        # the population std, defined (zero, then min_std) for a single elite too
+        return self.gaussian(elites.mean(0), elites.std(0, unbiased=False).clamp(min=self.min_std))
+
+
+class MPPIPlanner(IterativePlanner):
+    # MPPI: the next round is drawn around the average of all candidates of the last one, weighted by
+    # exp(-cost / --mppi-temperature) with the costs scaled to unit standard deviation
+    def refine(self, actions, cost):
+        # candidates pruned during the rollout (--prune-rollout, cost inf) get no weight; the population std
+        # keeps the scaling defined when a single cost is finite
+        finite = torch.isfinite(cost)
+        scaled = torch.full_like(cost, float('inf'))
+        scaled[finite] = (cost[finite] - cost[finite].min()) / (cost[finite].std(unbiased=False) + 1e-6)
+        weight = F.softmax(-scaled / self.args.mppi_temperature, dim=0).view(-1, 1, 1)
+        mean = (weight * actions).sum(0)
+        std = (weight * (actions - mean) ** 2).sum(0).sqrt()
+        return self.gaussian(mean, std.clamp(min=self.min_std))
+
+
+planners = {'shooting': ShootingPlanner, 'cem': CEMPlanner, 'mppi': MPPIPlanner}
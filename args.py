@@ -23,6 +23,7 @@ def set_train_params(parser):
     # part1: basic params
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--checkpoint', type=str, default='')
+    parser.add_argument('--planner-engine', type=str, default='', help="directory of a planner exported by helper/export_planner.py, evaluation then plans with it on the CPU")
     parser.add_argument('--verbose', action='store_true')
     parser.add_argument('--output_path', type=str, default='demo', help="output path to save evaluation results")
     parser.add_argument('--port', type=int, default=6666)
@@ -58,6 +59,16 @@ def set_train_params(parser):
     parser.add_argument('--temperature', type=float, default=5.0)
     parser.add_argument('--SAS', action='store_true', help="whether to enable sequential action sampling")
     parser.add_argument('--SAS_thred', type=int, default=5, help="number of action candidates remaining after the first stage of SAS")
+    parser.add_argument('--sample-on-device', action='store_true', help="draw action candidates with torch on the model's device")
+    parser.add_argument('--cand-num', type=int, default=20, help="number of action candidates evaluated per planning round, more than --SAS_thred")
+    parser.add_argument('--warm-start', action='store_true', help="draw part of the candidates around the plan of the last step, shifted by one step")
+    parser.add_argument('--planner', type=str, default='shooting', choices=['shooting', 'cem', 'mppi'], help="shooting draws one round of candidates, cem / mppi refine the candidate distribution over several rounds")
+    parser.add_argument('--plan-rounds', type=int, default=4, help="maximum number of candidate rounds per step of the cem / mppi planners")
+    parser.add_argument('--plan-budget', type=float, default=0, help="wall-clock budget (ms) of one planning step, no more rounds start once it would be exceeded; 0 for no budget")
+    parser.add_argument('--mppi-temperature', type=float, default=0.1, help="temperature of the mppi candidate weights, on costs scaled to unit standard deviation")
+    parser.add_argument('--prune-rollout', action='store_true', help="stop rolling out the candidates that can no longer reach the top candidates by cost")
+    parser.add_argument('--prune-speed-limit', type=float, default=50, help="upper bound of the predicted speeds in the cost with --prune-rollout, higher predictions are clamped")
+    parser.add_argument('--sample-seed', type=int, default=None, help="seed of the action candidate generator, drawn from numpy's global state if not set")
 
     # part4: training params
     parser.add_argument('--lr', type=float, default=5e-3, metavar='LR', help='learning rate')
@@ -68,6 +79,9 @@ def set_train_params(parser):
     parser.add_argument('--save-freq', type=int, default=1000)
     parser.add_argument('--save-path', type=str, default='spc')
     parser.add_argument('--buffer-size', type=int, default=20000)
+    parser.add_argument('--prefetch-batches', type=int, default=2, help="number of training batches prepared in the background, 0 to disable")
+    parser.add_argument('--prefetch-workers', type=int, default=2, help="threads used to assemble prefetched batches")
+    parser.add_argument('--buffer-mmap', action='store_true', help="keep the replay buffer in memory-mapped files under the checkpoint folder")
     parser.add_argument('--num-total-act', type=int, default=2)
     parser.add_argument('--epsilon-frames', type=int, default=50000)
     parser.add_argument('--learning-freq', type=int, default=100)
@@ -86,6 +100,9 @@ def set_model_params(parser):
     parser.add_argument('--pretrained', type=bool, default=True)
     parser.add_argument('--drn-model', type=str, default='dla46x_c')
     parser.add_argument('--classes', type=int, default=6)
+    parser.add_argument('--batch-heads', action='store_true', help="run the prediction heads once over all predicted steps after the ConvLSTM rollout")
+    parser.add_argument('--stateful-rollout', action='store_true', help="carry the ConvLSTM state across predicted steps instead of replaying the history window at each step")
+    parser.add_argument('--lowres-events', action='store_true', help="plan with event heads reading the 1/8 scale class map, distilled from the full-resolution heads")
     # return parser
 
 
@@ -94,6 +111,11 @@ def set_common_params(parser):
     parser.add_argument('--resume', action='store_true')
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--data-parallel', action='store_true')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cuda', 'cpu'], help="device the model, buffers and losses run on, auto picks cuda when available")
+    parser.add_argument('--cpu-threads', type=int, default=0, help="intra-op threads of torch on the CPU, 0 keeps the torch default")
+    parser.add_argument('--interop-threads', type=int, default=0, help="inter-op threads of torch on the CPU, 0 keeps the torch default")
+    parser.add_argument('--channels-last', action='store_true', help="keep the model weights in channels-last memory format")
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'fp16', 'bf16'], help="mixed precision for training and planning: fp16 autocast with loss scaling (cuda only) or bf16 autocast")
     parser.add_argument('--id', type=int, default=0)
     parser.add_argument('--save-record', action='store_true', help="whether to save visulization of real-time observations")
     parser.add_argument('--logger_path', type=str, default="wandb_log.txt")
@@ -110,6 +132,7 @@ def init_parser(parser):
 
 def post_processing(args):
     import os
+    import torch
     import torchvision.transforms as transforms
     args.env = args.env.lower()
     args.save_path = '{}vehicle/{}'.format(args.vehicle_num, args.id)
@@ -123,6 +146,20 @@ def post_processing(args):
 
     args.sync = 'torcs' in args.env or 'carla' in args.env
 
+    # one device for the model, the replay batches, the sampler and the losses
+    if args.device == 'auto':
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.cpu_threads > 0:
+        torch.set_num_threads(args.cpu_threads)
+    if args.interop_threads > 0:
+        # only allowed before the first inter-op parallel work, post_processing runs right after parsing
+        torch.set_num_interop_threads(args.interop_threads)
+    # ActionSampleManager.select keeps the --SAS_thred lowest costs out of the candidates of a round
+    if args.cand_num <= args.SAS_thred:
+        raise ValueError("--cand-num ({}) must be more than --SAS_thred ({})".format(args.cand_num, args.SAS_thred))
+    if args.amp == 'fp16' and args.device != 'cuda':
+        raise ValueError("--amp fp16 needs cuda, use --amp bf16 on the CPU")
+
     # transform on the original image / 255
     args.trans = transforms.Compose([
         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
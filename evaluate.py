@@ -1,8 +1,9 @@
 from __future__ import division, print_function
 from manager import BufferManager
 from actionsampler import ActionSampleManager
-from utils import generate_guide_grid, log_frame, record_screen, draw_from_pred, from_variable_to_numpy, monitor_guide, norm_image
+from utils import generate_guide_grid, log_frame, record_screen, draw_from_pred, from_variable_to_numpy, monitor_guide, norm_image, amp_autocast
 from models import init_models
+from planner import PlannerEngine
 import os
 import sys
 import cv2
@@ -88,11 +89,14 @@ def net_infer(args, obs_var, action, net, action_var):
     obs_var = obs_var.view(1, 1, 3*args.frame_history_len, args.frame_height, args.frame_width)
 
     action = torch.from_numpy(action).view(1, args.pred_step, args.num_total_act)
-    action = Variable(action.cuda().float(), requires_grad=False)
+    action = Variable(action.to(args.device).float(), requires_grad=False)
 
     net = net.eval()
     with torch.no_grad():
-        output = net(obs_var, action, training=False, action_var=action_var)
+        with amp_autocast(args):
+            output = net(obs_var, action, training=False, action_var=action_var.to(args.device))
+        # the drawing and box decoding read FP32 (numpy has no bfloat16)
+        output = {key: value.float() if torch.is_tensor(value) and value.is_floating_point() else value for key, value in output.items()}
         if args.use_offroad:
             output['offroad_prob'] = F.softmax(output['offroad_prob'], -1)
         if args.use_collision:
@@ -109,6 +113,8 @@ def evaluate_policy(args, env):
     guides = generate_guide_grid(args.bin_divide)
     args.checkpoint = args.checkpoint
     net, optimizer, epoch, exploration, num_steps = init_models(args)
+    # the exported planner only replaces the planning, the predictions drawn below still come from net
+    planner = PlannerEngine(args.planner_engine) if args.planner_engine != '' else net
     output_path = args.output_path
     for episode in range(100):
         buffer_manager = BufferManager(args)
@@ -126,14 +132,15 @@ def evaluate_policy(args, env):
 
         for step in range(args.max_eval_step):
             obs_var = buffer_manager.store_frame(obs, info)
-            action, guide_action, p = action_manager.sample_action(net=net,
+            action, guide_action, p = action_manager.sample_action(net=planner,
                                                                 obs=obs,
                                                                 obs_var=obs_var,
                                                                 action_var=action_var,
                                                                 exploration=exploration,
                                                                 step=step,
                                                                 explore=False,
-                                                                testing=True)
+                                                                testing=True,
+                                                                feature_cache=buffer_manager.feature_cache)
             
             # in the test mode, sample_action outputs the guide_action and action
             # for future pred_step steps, while we only take those for the next frame
@@ -142,16 +149,12 @@ def evaluate_policy(args, env):
 
             bboxes, labels, scores = [], [], []
             if args.use_detection:
-                loc_preds, cls_preds = output['loc_pred'][0].cpu(), output['cls_pred'][0].cpu()
-                
-                for find in range(loc_preds.size(0)):
-                    print(cls_preds[find].sigmoid().max())
-                    frame_loc_pred = loc_preds[find]
-                    frame_cls_pred = cls_preds[find]
-                    pred_bboxes, pred_labels, pred_scores = encoder.decode(frame_loc_pred, frame_cls_pred, input_size=(args.frame_width, args.frame_height))
-                    bboxes.append(pred_bboxes)
-                    labels.append(pred_labels)
-                    scores.append(pred_scores)
+                # decode all predicted frames at once, on the device the model runs on
+                pred_bboxes, pred_labels, pred_scores, pred_nums = encoder.decode_many(output['loc_pred'][0], output['cls_pred'][0], input_size=(args.frame_width, args.frame_height))
+                for find, num in enumerate(pred_nums.tolist()):
+                    bboxes.append(pred_bboxes[find, :num])
+                    labels.append(pred_labels[find, :num])
+                    scores.append(pred_scores[find, :num])
             
             draw_prediction(step, args, output, bboxes, scores, 'outcome', '{}/{}'.format(output_path, episode))
 
@@ -165,6 +168,8 @@ def evaluate_policy(args, env):
             draw_current_frame(args, action, obs_ori, p, None, bboxes, scores, os.path.join(output_path, str(episode), str(step)), step)
 
             print("step: {0} | action [{1:.2f}, {2:.2f}] coll {3} offroad {4} offlane {5} speed {6:.2f} reward {7:.2f}".format(step, action[0], action[1], info['collision'], info['offroad'],info['offlane'], info['speed'], reward))
+            stats = action_manager.plan_stats
+            print("planning | rounds {} | candidates {} | {:.1f} ms".format(stats['plan_rounds'], stats['plan_candidates'], stats['plan_latency']))
 
             action_var = buffer_manager.store_effect(guide_action=guide_action,
                                                     action=action,
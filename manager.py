@@ -1,5 +1,6 @@
 import os
 import copy
+from collections import OrderedDict
 import numpy as np
 import torch
 from utils import setup_logger
@@ -43,6 +44,38 @@ class BufferManager:
             self.last_action_all = []
             return
 
+    class FeatureCache:
+        # FPN features of the frames in the sliding history window, keyed by their SPCBuffer index,
+        # so that a frame is encoded once while it stays in the window instead of once per step
+        def __init__(self, frame_history_len=3):
+            self.frame_history_len = frame_history_len
+            self.window = []
+            self.features = OrderedDict()
+
+        def store_frame(self, idx):
+            if not len(self.window) == self.frame_history_len:
+                self.window = [idx for i in range(self.frame_history_len)]
+            else:
+                self.window = self.window[1:] + [idx]
+            # frames that slid out of the window are never needed again
+            for key in list(self.features.keys()):
+                if key not in self.window:
+                    del self.features[key]
+
+        def get(self, idx):
+            return self.features.get(idx)
+
+        def put(self, idx, feature):
+            self.features[idx] = feature
+
+        def invalidate(self):
+            # the cached features are stale once the network weights change
+            self.features.clear()
+
+        def clear(self):
+            self.window = []
+            self.features.clear()
+
     def __init__(self, args=None):
         self.args = args
         mode = 'eval' if args.eval else 'train'
@@ -53,6 +86,7 @@ class BufferManager:
             self.spc_buffer.load(args.save_path)
         self.obs_buffer = self.ObsBuffer(args.frame_history_len)
         self.action_buffer = self.ActionBuffer(args.frame_history_len - 1)
+        self.feature_cache = self.FeatureCache(args.frame_history_len)
 
         self.prev_act = np.array([1.0, 0.0])
         self.reward = 0.0
@@ -66,7 +100,7 @@ class BufferManager:
     def store_frame(self, obs, info):  
         past_n_frames = self.obs_buffer.store_frame(obs)
 
-        obs_var = Variable(torch.from_numpy(past_n_frames).unsqueeze(0).float().cuda())
+        obs_var = Variable(torch.from_numpy(past_n_frames).unsqueeze(0).float().to(self.args.device))
 
         self.spc_buffer.store_frame(obs=obs,
                                     collision=info['collision'],
@@ -80,6 +114,7 @@ class BufferManager:
                                     bboxes=info["bboxes"],
                                     depth=info['depth'])
         self.idx_buffer.append(self.spc_buffer.last_idx)
+        self.feature_cache.store_frame(self.spc_buffer.last_idx)
         self.dist_sum += info['speed']
 
         return obs_var
@@ -98,6 +133,7 @@ class BufferManager:
     def reset(self, step):
         self.obs_buffer.clear()
         self.action_buffer.clear()
+        self.feature_cache.clear()
         self.prev_act = np.array([1.0, 0.0])
 
         self.reward_logger.info('step {} reward {}'.format(step, self.reward))
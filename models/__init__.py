@@ -1,2 +1,2 @@
-from .model import init_models
+from .model import init_models, unwrap_model
 from .loss import FocalLoss
\ No newline at end of file
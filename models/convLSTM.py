@@ -1,8 +1,7 @@
 import torch
 import torch.nn as nn
-# import torch.nn.functional as F
-from torch.autograd import Variable
-from utils.util import weights_init
+import torch.nn.functional as F
+from utils.util import weights_init, TiledFeature
 
 
 class convLSTMCell(nn.Module):
@@ -11,32 +10,77 @@ class convLSTMCell(nn.Module):
         self.feature_channels = feature_channels
         self.conv = nn.Conv2d(in_channels + feature_channels, 4 * feature_channels, kernel_size, stride, padding, dilation, groups, bias)
         self.apply(weights_init)
+        self._split = None
     
     def forward(self, x, hidden_states):
+        # x: tensor or TiledFeature; hidden_states (None, None) is the zero initial state
         hx, cx = hidden_states
-        combined = torch.cat([x, hx], dim=1)
-        A = self.conv(combined)
+        if isinstance(x, TiledFeature) and not torch.is_grad_enabled():
+            A = self.decomposed_gates(x, hx)
+        else:
+            if isinstance(x, TiledFeature):
+                x = x.materialize()
+            if hx is None:
+                hx = torch.zeros(x.size(0), self.feature_channels, *x.size()[2:], device=x.device, dtype=x.dtype)
+            combined = torch.cat([x, hx], dim=1)
+            A = self.conv(combined)
         (ai, af, ao, ag) = torch.split(A, self.feature_channels, dim=1)#it should return 4 tensors
         i = torch.sigmoid(ai)
         f = torch.sigmoid(af)
         o = torch.sigmoid(ao)
         g = torch.tanh(ag)
 
-        next_c = f * cx + i * g
+        next_c = i * g if cx is None else f * cx + i * g
         next_h = o * torch.tanh(next_c)
         return next_h, next_c
 
+    def split_weights(self, feature_channels, size):
+        # the gate conv weight split into its feature / action / hidden input channels, and the
+        # response of the action channels to a constant 1 (zero padding makes it smaller at the borders),
+        # cached until the weight is updated in place or moved
+        weight = self.conv.weight
+        key = (weight.data_ptr(), weight._version, feature_channels, tuple(size))
+        if self._split is None or self._split[0] != key:
+            action_channels = weight.size(1) - feature_channels - self.feature_channels
+            w_x = weight[:, :feature_channels].contiguous()
+            w_a = weight[:, feature_channels: feature_channels + action_channels].contiguous()
+            w_h = weight[:, feature_channels + action_channels:].contiguous()
+            w_xh = torch.cat([w_x, w_h], dim=1)
+            # row a of the identity input lights up action channel a alone
+            ones = torch.eye(action_channels, device=weight.device, dtype=weight.dtype).view(action_channels, action_channels, 1, 1)
+            ones = ones.repeat(1, 1, *size)
+            action_response = F.conv2d(ones, w_a, None, self.conv.stride, self.conv.padding, self.conv.dilation)
+            self._split = (key, w_x, w_h, w_xh, action_response)
+        return self._split[1:]
+
+    def decomposed_gates(self, x, hx):
+        # conv(cat([feature, tile(action), hx])) computed as conv(feature) + conv(hx) + sum_a action_a * response_a:
+        # the feature and hidden parts run at their own batch size (1 when shared by all candidates of a rollout)
+        # and broadcast against the per-sample action term
+        w_x, w_h, w_xh, action_response = self.split_weights(x.feature.size(1), x.feature.size()[2:])
+        conv = lambda t, w, b: F.conv2d(t, w, b, self.conv.stride, self.conv.padding, self.conv.dilation)
+        if hx is None:
+            A = conv(x.feature, w_x, self.conv.bias)
+        elif hx.size(0) == x.feature.size(0):
+            A = conv(torch.cat([x.feature, hx], dim=1), w_xh, self.conv.bias)
+        else:
+            A = conv(x.feature, w_x, self.conv.bias) + conv(hx, w_h, None)
+        return A + torch.einsum('na,achw->nchw', x.action.to(action_response.dtype), action_response)
+
 
 class convLSTM(nn.Module):
-    def __init__(self, args, channel=256):
+    # (kernel_size, padding) of the cell for each pyramid level, finest first
+    level_kernels = [(5, 2), (3, 1), (3, 1), (1, 0), (1, 0)]
+
+    def __init__(self, args, channel=256, num_levels=5):
         super(convLSTM, self).__init__()
         self.args = args
         self.channel = channel
-        self.lstm0 = convLSTMCell(258, self.channel, kernel_size=5, padding=2)
-        self.lstm1 = convLSTMCell(258, self.channel, kernel_size=3, padding=1)
-        self.lstm2 = convLSTMCell(258, self.channel, kernel_size=3, padding=1)
-        self.lstm3 = convLSTMCell(258, self.channel, kernel_size=1, padding=0)
-        self.lstm4 = convLSTMCell(258, self.channel, kernel_size=1, padding=0)
+        # only the cells of the first num_levels pyramid levels are built and run
+        self.num_levels = num_levels
+        for level in range(self.num_levels):
+            kernel_size, padding = self.level_kernels[level]
+            setattr(self, 'lstm{}'.format(level), convLSTMCell(258, self.channel, kernel_size=kernel_size, padding=padding))
 
         # self.identifies = [nn.Conv2d(258, self.channel, kernel_size=1, stride=1) for _ in range(5)]
         # self.stairs = [nn.Conv2d(self.channel, self.channel, kernel_size=1, stride=1) for _ in range(5)]
@@ -48,71 +92,29 @@ class convLSTM(nn.Module):
         # self.identify3 = nn.Conv2d(258, self.channel, kernel_size=1, stride=1)
         # self.identify4 = nn.Conv2d(258, self.channel, kernel_size=1, stride=1)
 
-    def forward(self, x):
-        batch_size = x[0][0].shape[0]
-        h, w = self.args.frame_height, self.args.frame_width
-        
-        # The last two dimensions should be: frame_height / 8, frame_width / 8
-        hx0 = Variable(torch.zeros(batch_size, self.channel, int(h/8), int(w/8)))
-        cx0 = Variable(torch.zeros(batch_size, self.channel, int(h/8), int(w/8)))
-        # The last two dimensions should be: frame_height / 16, frame_width / 16
-        hx1 = Variable(torch.zeros(batch_size, self.channel, int(h/16), int(w/16)))
-        cx1 = Variable(torch.zeros(batch_size, self.channel, int(h/16), int(w/16)))
-        # The last two dimensions should be: frame_height / 32, frame_width / 32
-        hx2 = Variable(torch.zeros(batch_size, self.channel, int(h/32), int(w/32)))
-        cx2 = Variable(torch.zeros(batch_size, self.channel, int(h/32), int(w/32)))
-        # The last two dimensions should be: frame_height / 64, frame_width / 64
-        hx3 = Variable(torch.zeros(batch_size, self.channel, int(h/64), int(w/64)))
-        cx3 = Variable(torch.zeros(batch_size, self.channel, int(h/64), int(w/64)))
-        # The last two dimensions should be: frame_height / 128, frame_width / 128
-        hx4 = Variable(torch.zeros(batch_size, self.channel, int(h/128), int(w/128)))
-        cx4 = Variable(torch.zeros(batch_size, self.channel, int(h/128), int(w/128)))
-        
-        '''
-        # The last two dimensions should be: frame_height / 4, frame_width / 4
-        hx0 = torch.zeros(batch_size, self.channel, int(h/4), int(w/4))
-        cx0 = torch.zeros(batch_size, self.channel, int(h/4), int(w/4))
-        # The last two dimensions should be: frame_height / 8, frame_width / 8
-        hx1 = torch.zeros(batch_size, self.channel, int(h/8), int(w/8))
-        cx1 = torch.zeros(batch_size, self.channel, int(h/8), int(w/8))
-        # The last two dimensions should be: frame_height / 16, frame_width / 16
-        hx2 = torch.zeros(batch_size, self.channel, int(h/16), int(w/16))
-        cx2 = torch.zeros(batch_size, self.channel, int(h/16), int(w/16))
-        # The last two dimensions should be: frame_height / 32, frame_width / 32
-        hx3 = torch.zeros(batch_size, self.channel, int(h/32), int(w/32))
-        cx3 = torch.zeros(batch_size, self.channel, int(h/32), int(w/32))
-        # The last two dimensions should be: frame_height / 64, frame_width / 64
-        hx4 = torch.zeros(batch_size, self.channel, int(h/64), int(w/64))
-        cx4 = torch.zeros(batch_size, self.channel, int(h/64), int(w/64))
-        '''
-        if torch.cuda.is_available():
-            hx0 = hx0.cuda()
-            cx0 = cx0.cuda()
-            hx1 = hx1.cuda()
-            cx1 = cx1.cuda()
-            hx2 = hx2.cuda()
-            cx2 = cx2.cuda()
-            hx3 = hx3.cuda()
-            cx3 = cx3.cuda()
-            hx4 = hx4.cuda()
-            cx4 = cx4.cuda()
-        
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the full model also carry the cells of the levels skipped here
+        for level in range(self.num_levels, len(self.level_kernels)):
+            for key in [key for key in state_dict.keys() if key.startswith('{}lstm{}.'.format(prefix, level))]:
+                del state_dict[key]
+        super(convLSTM, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        for step in range(len(x)):
-            hx0, cx0 = self.lstm0(x[step][0], (hx0, cx0))
+    def step(self, x, state=None):
+        # advance the recurrent state by one frame pyramid (tensors or TiledFeatures)
+        # state is the (hx, cx) lists of the previous call, None for the zero initial state
+        hx, cx = state if state is not None else ([None] * self.num_levels, [None] * self.num_levels)
+        hx, cx = list(hx), list(cx)
+        for level in range(self.num_levels):
+            cell = getattr(self, 'lstm{}'.format(level))
+            hx[level], cx[level] = cell(x[level], (hx[level], cx[level]))
             # cx0 = self.stair(self.identify(x[step][0]) + cx0)
             # cx0 = self.stair(cx0)
-            hx1, cx1 = self.lstm1(x[step][1], (hx1, cx1))
-            # cx1 = self.stair(self.identify(x[step][1]) + cx1)
-            # cx1 = self.stair(cx1)
-            hx2, cx2 = self.lstm2(x[step][2], (hx2, cx2))
-            # cx2 = self.stair(self.identify(x[step][2]) + cx2)
-            # cx2 = self.stair(cx2)
-            hx3, cx3 = self.lstm3(x[step][3], (hx3, cx3))
-            # cx3 = self.stair(self.identify(x[step][3]) + cx3)
-            # cx3 = self.stair(cx3)
-            hx4, cx4 = self.lstm4(x[step][4], (hx4, cx4))
-            # cx4 = self.stair(self.identify(x[step][4]) + cx4)
-            # cx4 = self.stair(cx4)
+        return hx, cx
 
-        return [hx0, hx1, hx2, hx3, hx4]
+    def forward(self, x):
+        # x: sequence of per-frame feature pyramids (tensors or TiledFeatures), each holding at least num_levels levels
+        # the states start at zero, the level l state is frame_height / 2**(l+3) x frame_width / 2**(l+3)
+        state = None
+        for frame in x:
+            state = self.step(frame, state)
+        return state[0]
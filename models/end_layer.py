@@ -1,16 +1,20 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from utils.util import weights_init
 
 
 class end_layer(nn.Module):
-    def __init__(self, args, in_channels, out_dim, activate=None):
+    def __init__(self, args, in_channels, out_dim, activate=None, low_res=False):
         super(end_layer, self).__init__()
         self.args, self.activate = args, activate
 
-        self.conv1 = nn.Conv2d(in_channels, 16, 5, stride=2, padding=1)
-        self.conv2 = nn.Conv2d(16, 32, 3, stride=2, padding=1)
-        self.conv3 = nn.Conv2d(32, 64, 3, stride=2, padding=1)
+        # a low_res layer reads a map at 1/8 of the frame size (the scale of fms[0]),
+        # its convs keep the resolution so that the fc layers see the same flatten_len
+        stride = 1 if low_res else 2
+        self.conv1 = nn.Conv2d(in_channels, 16, 5, stride=stride, padding=2 if low_res else 1)
+        self.conv2 = nn.Conv2d(16, 32, 3, stride=stride, padding=1)
+        self.conv3 = nn.Conv2d(32, 64, 3, stride=stride, padding=1)
         self.conv4 = nn.Conv2d(64, 32, 1, stride=1, padding=0)
 
         self.flatten_len = int(32 * (self.args.frame_width / 128) * (self.args.frame_height / 128))
@@ -34,11 +38,84 @@ class end_layer(nn.Module):
         x = x.view(x.size(0), -1)
         # print(x.shape)
         # print("----")
-        x = F.relu(self.fc11(x), inplace=True)
-        x = F.relu(self.fc22(x), inplace=True)
-        x = self.fc33(x)
+        x = F.relu(self.fc1(x), inplace=True)
+        x = F.relu(self.fc2(x), inplace=True)
+        x = self.fc3(x)
 
         if self.activate is not None:
             x = self.activate(x)
 
         return x
+
+
+class batched_linear(nn.Module):
+    # num_heads Linear layers applied to their own inputs with one batched matmul
+    def __init__(self, num_heads, in_features, out_features):
+        super(batched_linear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(num_heads, out_features, in_features))
+        self.bias = nn.Parameter(torch.zeros(num_heads, out_features))
+
+    def forward(self, x, heads=None):
+        # x: len(heads) x B x in_features
+        weight, bias = (self.weight, self.bias) if heads is None else (self.weight[heads], self.bias[heads])
+        return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+
+
+class fused_end_layer(nn.Module):
+    '''
+    num_heads end_layers reading the same input, run as one stack: conv1 holds the filters of all heads,
+    the following convs are grouped by head and the fc layers are batched matmuls over the heads.
+    Head i computes what an end_layer with the weights of fuse_end_layers' i-th name computes.
+    '''
+    def __init__(self, args, in_channels, out_dim, num_heads, low_res=False):
+        super(fused_end_layer, self).__init__()
+        self.args, self.num_heads = args, num_heads
+
+        stride = 1 if low_res else 2
+        self.conv1 = nn.Conv2d(in_channels, 16 * num_heads, 5, stride=stride, padding=2 if low_res else 1)
+        self.conv2 = nn.Conv2d(16 * num_heads, 32 * num_heads, 3, stride=stride, padding=1, groups=num_heads)
+        self.conv3 = nn.Conv2d(32 * num_heads, 64 * num_heads, 3, stride=stride, padding=1, groups=num_heads)
+        self.conv4 = nn.Conv2d(64 * num_heads, 32 * num_heads, 1, stride=1, padding=0, groups=num_heads)
+
+        self.flatten_len = int(32 * (self.args.frame_width / 128) * (self.args.frame_height / 128))
+        self.fc1 = batched_linear(num_heads, self.flatten_len, 128)
+        self.fc2 = batched_linear(num_heads, 128, 32)
+        self.fc3 = batched_linear(num_heads, 32, out_dim)
+
+        # initialize every head as a separate end_layer would be
+        heads = [end_layer(args, in_channels, out_dim, low_res=low_res) for _ in range(num_heads)]
+        state_dict = {'{}.{}'.format(i, key): value for i, head in enumerate(heads) for key, value in head.state_dict().items()}
+        state_dict = fuse_end_layers(state_dict, [str(i) for i in range(num_heads)], 'fused')
+        self.load_state_dict({key[len('fused.'):]: value for key, value in state_dict.items()})
+
+    def conv(self, layer, x, heads=None, groups=1):
+        weight, bias = layer.weight, layer.bias
+        if heads is not None:
+            weight = weight.view(self.num_heads, -1, *weight.shape[1:])[heads].flatten(0, 1)
+            bias = bias.view(self.num_heads, -1)[heads].flatten()
+        return F.conv2d(x, weight, bias, layer.stride, layer.padding, groups=groups)
+
+    def forward(self, x, heads=None):
+        # x: B x in_channels x H x W, heads: indices of the heads to run, all by default
+        # returns len(heads) x B x out_dim
+        num_heads = self.num_heads if heads is None else len(heads)
+        x = F.relu(F.max_pool2d(self.conv(self.conv1, x, heads), kernel_size=2, stride=2), inplace=True)
+        x = F.relu(F.max_pool2d(self.conv(self.conv2, x, heads, num_heads), kernel_size=2, stride=2), inplace=True)
+        x = F.relu(F.max_pool2d(self.conv(self.conv3, x, heads, num_heads), kernel_size=2, stride=2), inplace=True)
+        x = F.relu(F.max_pool2d(self.conv(self.conv4, x, heads, num_heads), kernel_size=2, stride=2), inplace=True)
+        x = x.view(x.size(0), num_heads, -1).transpose(0, 1)
+        x = F.relu(self.fc1(x, heads), inplace=True)
+        x = F.relu(self.fc2(x, heads), inplace=True)
+        return self.fc3(x, heads)
+
+
+def fuse_end_layers(state_dict, names, fused_name):
+    # convert a state dict holding one end_layer per name (full module names) into the layout of the
+    # fused_end_layer fused_name with these heads in order, in place; a state dict without them is left as it is
+    prefixes = [name + '.' for name in names]
+    if not all(any(key.startswith(prefix) for key in state_dict) for prefix in prefixes):
+        return state_dict
+    for param in [key[len(prefixes[0]):] for key in list(state_dict.keys()) if key.startswith(prefixes[0])]:
+        values = [state_dict.pop(prefix + param) for prefix in prefixes]
+        state_dict[fused_name + '.' + param] = torch.stack(values) if param.startswith('fc') else torch.cat(values)
+    return state_dict
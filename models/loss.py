@@ -42,7 +42,7 @@ class FocalLoss(nn.Module):
 
         t = one_hot_embedding(y.data.cpu(), 1+self.num_classes)  # [N,21]
         t = t[:,1:]  # exclude background
-        t = Variable(t).cuda()  # [N,20]
+        t = Variable(t).to(x.device)  # [N,20]
 
         p = x.sigmoid()
         pt = p*t + (1-p)*(1-t)         # pt = p if t > 0 else 1-p
@@ -64,7 +64,7 @@ class FocalLoss(nn.Module):
 
         t = one_hot_embedding(y.data.cpu(), 1+self.num_classes)
         t = t[:,1:]
-        t = Variable(t).cuda()
+        t = Variable(t).to(x.device)
 
         xt = x*(2*t-1)  # xt = x if t > 0 else -x
         pt = (2*xt+1).sigmoid()
@@ -91,6 +91,10 @@ class FocalLoss(nn.Module):
           (tensor) loss = SmoothL1Loss(loc_preds, loc_targets) + FocalLoss(cls_preds, cls_targets).
         '''
 
+        # the focal terms (sigmoid, log, pow) are computed in FP32, the predictions may be half precision under --amp
+        loc_preds, cls_preds = loc_preds.float(), cls_preds.float()
+        if pred_colls_with is not None:
+            pred_colls_with = pred_colls_with.float()
         batch_size, step_num, anchor_num, class_num = cls_preds.shape
         cls_targets = cls_targets.view(-1, anchor_num)
         cls_preds = cls_preds.view(-1, anchor_num, class_num)
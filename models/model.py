@@ -4,8 +4,8 @@ from torch import optim
 import numpy as np
 import os
 from models.convLSTM import convLSTM
-from models.end_layer import end_layer
-from utils import PiecewiseSchedule, tile, tile_first, load_model
+from models.end_layer import end_layer, fused_end_layer, fuse_end_layers
+from utils import PiecewiseSchedule, tile, tile_first, take_batch, load_model
 from models.retinanet import FPN50, RetinaNet_Header
 import torch.nn.init as init
 import math
@@ -30,9 +30,13 @@ class ConvLSTMNet(nn.Module):
     def __init__(self, args):
         super(ConvLSTMNet, self).__init__()
         self.args = args
+        # seg, depth and the event heads only read the finest level (p3),
+        # the coarser levels are needed by the detector only
+        self.num_levels = 5 if self.args.use_detection else 1
+
         # Feature extraction and prediction
-        self.fpn = FPN50()
-        self.feature_map_predictor = convLSTM(self.args)
+        self.fpn = FPN50(self.num_levels)
+        self.feature_map_predictor = convLSTM(self.args, num_levels=self.num_levels)
 
         # since the distribution different between feature maps from real RGB images
         # and those from LSTM, we compromisingly use two detectors, each for one case
@@ -67,13 +71,41 @@ class ConvLSTMNet(nn.Module):
 
         # Information prediction
         self.guide_layer = end_layer(args, args.classes, int(np.prod(args.bin_divide)))
-        self.coll_layer = end_layer(args, args.classes, 2)
+        # the collision, offroad and offlane heads (frame_events) read the same class map, they run as one fused stack
+        self.event_layer = fused_end_layer(args, args.classes, 2, len(self.frame_events))
         # self.coll_vehicle_layer = end_layer(args, args.classes, 2)
         # self.coll_other_layer = end_layer(args, args.classes, 2)
-        self.offroad_layer = end_layer(args, args.classes, 2)
-        self.offlane_layer = end_layer(args, args.classes, 2)
         self.speed_layer = end_layer(args, args.classes * args.frame_history_len, 1)
 
+        # with --lowres-events every event head has a counterpart reading the class map at the scale of fms[0],
+        # planning uses them instead of upsampling to full resolution, training distills them from the full heads
+        if self.args.lowres_events:
+            self.lowres_event_layer = fused_end_layer(args, args.classes, 2, len(self.frame_events), low_res=True)
+            self.lowres_speed_layer = end_layer(args, args.classes * args.frame_history_len, 1, low_res=True)
+
+        # checkpoints from before the fused event heads hold one end_layer per event
+        self._register_load_state_dict_pre_hook(self.fuse_event_layers)
+
+        # whether each optional output is computed when the caller does not request specific outputs
+        # the 3D detection head is not mature, its outputs are only computed with --use-3d-detection or on request
+        use_3d = self.args.use_detection and self.args.use_3d_detection
+        self.default_outputs = {
+            'depth_pred': self.args.use_depth,
+            'loc_pred': self.args.use_detection,
+            'cls_pred': self.args.use_detection,
+            'colls_with_prob': self.args.use_detection and self.args.use_colls_with,
+            'residual_pred': use_3d,
+            'conf_pred': use_3d,
+            'dim_pred': use_3d,
+            'center_pred': use_3d,
+            'coll_prob': self.args.use_collision,
+            'offroad_prob': self.args.use_offroad,
+            'offlane_prob': self.args.use_offlane,
+            'speed': self.args.use_speed,
+        }
+        for key in self.frame_events + ['speed']:
+            self.default_outputs[key + '_low'] = self.args.lowres_events and self.default_outputs[key]
+
     def freeze_bn(self):
         '''Freeze BatchNorm layers.'''
         for layer in self.fpn.modules():
@@ -84,95 +116,235 @@ class ConvLSTMNet(nn.Module):
             if isinstance(layer, nn.BatchNorm2d):
                 layer.eval()
 
-    def fm_infer(self, fms):
+    def needs(self, key, outputs=None):
+        # whether the head producing output key has to run, outputs is the set of keys requested by the caller
+        # (named as in the ConvLSTMMulti output, e.g. {'coll_prob', 'speed'}), None for the defaults given by the flags
+        if key in self.detection_outputs and not self.args.use_detection:
+            # without detection the coarse pyramid levels the detector reads are not built
+            return False
+        if outputs is None:
+            return self.default_outputs.get(key, True)
+        return key in outputs
+
+    # detector outputs in the order RetinaNet_Header returns them
+    detection_outputs = ['loc_pred', 'cls_pred', 'colls_with_prob', 'residual_pred', 'conf_pred', 'dim_pred', 'center_pred']
+
+    def detect(self, fms, names, outputs=None):
+        # run the detector heads needed for outputs, names are the keys of its outputs for this frame
+        if not any(self.needs(key, outputs) for key in self.detection_outputs):
+            return dict()
+        preds = self.detector(fms, with_box=self.needs('loc_pred', outputs) or self.needs('cls_pred', outputs),
+                              with_coll=self.needs('colls_with_prob', outputs),
+                              with_3d=any(self.needs(key, outputs) for key in self.detection_outputs[3:]))
+        return {name: pred for name, pred in zip(names, preds) if pred is not None}
+
+    # the event heads reading one frame's class map, in the order of the fused event layers' heads;
+    # the speed head reads the window of the frame_history_len latest class maps
+    frame_events = ['coll_prob', 'offroad_prob', 'offlane_prob']
+
+    def fuse_event_layers(self, state_dict, prefix, *args):
+        # convert the separate event end_layers of an older state dict into the fused layout, in place
+        fuse_end_layers(state_dict, [prefix + name for name in ['coll_layer', 'offroad_layer', 'offlane_layer']], prefix + 'event_layer')
+        fuse_end_layers(state_dict, [prefix + 'lowres_layers.' + key for key in self.frame_events], prefix + 'lowres_event_layer')
+        for key in [key for key in state_dict.keys() if key.startswith(prefix + 'lowres_layers.speed.')]:
+            state_dict[prefix + 'lowres_speed_layer.' + key[len(prefix + 'lowres_layers.speed.'):]] = state_dict.pop(key)
+        # the low-resolution heads are distilled from the full-resolution ones: a state dict saved without
+        # --lowres-events (e.g. the pretrain model) leaves them at their initialization
+        if self.args.lowres_events:
+            for name in ['lowres_event_layer', 'lowres_speed_layer']:
+                for key, value in getattr(self, name).state_dict().items():
+                    state_dict.setdefault(prefix + name + '.' + key, value)
+
+    def lowres(self, outputs=None):
+        # whether the event heads read the low-resolution class map: with --lowres-events whenever the
+        # full-resolution segmentation is not requested, which is then not computed at all
+        return self.args.lowres_events and not self.needs('seg_pred', outputs)
+
+    def event_heads(self, keys, outputs=None):
+        # (output key, event, index of the class map it reads in (full, low)) of the heads of the events in keys to run,
+        # the low-resolution heads give the '_low' outputs the distillation loss compares to the full ones
+        heads = []
+        for key in keys:
+            if self.lowres(outputs):
+                if self.needs(key, outputs):
+                    heads.append((key, key, 1))
+                continue
+            if self.needs(key, outputs):
+                heads.append((key, key, 0))
+            if self.args.lowres_events and self.needs(key + '_low', outputs):
+                heads.append((key + '_low', key, 1))
+        return heads
+
+    def needs_lowres_map(self, outputs=None):
+        return any(index == 1 for _, _, index in self.event_heads(self.frame_events + ['speed'], outputs))
+
+    def speed_head(self, index):
+        return self.lowres_speed_layer if index == 1 else self.speed_layer
+
+    def infer_events(self, rxs, outputs=None):
+        # run the frame event heads on the (full, low) resolution class maps, one fused call per map
+        output_dict = dict()
+        heads = self.event_heads(self.frame_events, outputs)
+        for index, layer in [(0, 'event_layer'), (1, 'lowres_event_layer')]:
+            keys = [key for key, _, i in heads if i == index]
+            if len(keys) == 0:
+                continue
+            events = [self.frame_events.index(event) for _, event, i in heads if i == index]
+            preds = getattr(self, layer)(rxs[index].detach(), None if len(events) == len(self.frame_events) else events)
+            output_dict.update(zip(keys, preds))
+        return output_dict
+
+    def lowres_infer(self, fms):
+        # the class map at the scale of fms[0], from the 1x1 class projection the full-resolution path starts with
+        return self.softmax(self.up[0](fms[0]))
+
+    def fm_infer(self, fms, with_depth=True):
         feat = self.up(fms[0])
-        feat_depth = self.depth_head(fms[0])
+        feat_depth = self.depth_head(fms[0]) if with_depth else None
         seg = self.logsoftmax(feat)
         hidden = self.softmax(feat)
         return seg, hidden, feat_depth
 
     def act(self, x):
         fms = self.fpn(x)
-        _, hidden, _ = self.fm_infer(fms)
+        _, hidden, _ = self.fm_infer(fms, with_depth=False)
         logit = self.guide_layer(hidden.detach())
         return logit
 
-    def get_feature(self, x, train=True):
+    def encode_frame(self, frame):
+        fms = self.fpn(frame)
+        '''
+        shape of fms:
+            fms[0]: B x 256 x (H/8) x (W/8)
+            fms[1]: B x 256 x (H/16) x (W/16)
+            fms[2]: B x 256 x (H/32) x (W/32)
+            fms[3]: B x 256 x (H/64) x (W/64)
+            fms[4]: B x 256 x (H/128) x (W/128)
+        '''
+        # depth is only read for the last history frame, get_feature infers it there
+        seg, hidden, _ = self.fm_infer(fms, with_depth=False)
+        return fms, hidden, seg
+
+    def get_feature(self, x, train=True, feature_cache=None, with_depth=True):
         # one forward for a histroy frame sequence
+        # with a feature_cache (BufferManager.FeatureCache, batch size 1) frames encoded on earlier steps are reused
         fnum = x.size(1)
         assert(fnum % 3 == 0) 
         fnum = int(fnum / 3)
+        if feature_cache is not None:
+            assert len(feature_cache.window) == fnum and x.size(0) == 1
 
         fms_seq, hidden_seq = [], []
         for fidx in range(fnum):
-            frame = x[:, 3*fidx: 3*(fidx+1), :, :]
-            fms = self.fpn(frame)
-            '''
-            shape of fms:
-                fms[0]: B x 256 x (H/4) x (W/4)
-                fms[1]: B x 256 x (H/8) x (W/8)
-                fms[2]: B x 256 x (H/16) x (W/16)
-                fms[3]: B x 256 x (H/32) x (W/32)
-                fms[4]: B x 256 x (H/64) x (W/64)
-            '''
-            seg, hidden, depth = self.fm_infer(fms)
+            feature = None if feature_cache is None else feature_cache.get(feature_cache.window[fidx])
+            if feature is None:
+                frame = x[:, 3*fidx: 3*(fidx+1), :, :]
+                feature = self.encode_frame(frame)
+                if feature_cache is not None:
+                    feature_cache.put(feature_cache.window[fidx], feature)
+            fms, hidden, seg = feature
             fms_seq.append(fms)
             hidden_seq.append(hidden)
         hidden_seq = torch.cat(hidden_seq, dim=1)
+        depth = self.depth_head(fms[0]) if with_depth else None
         return fms_seq, hidden_seq, seg, depth, fms
 
 
-    def forward_next_step(self, fms_seq, action, with_encode=False, hidden=None, cell=None, training=True, action_var=None):
+    def predict_fms(self, fms_seq, action, state=None):
+        # the sequential part of a rollout step: tile the action onto the latest frame and
+        # predict the feature maps of the next frame, returns them with the shifted input window
+        # and the ConvLSTM state (--stateful-rollout), otherwise the whole window is replayed from a zero state
+        fms_seq[-1] = tile(fms_seq[-1], action)
+        if self.args.stateful_rollout:
+            state = self.feature_map_predictor.step(fms_seq[-1], state)
+            pred_fms = state[0]
+        else:
+            pred_fms = self.feature_map_predictor(fms_seq)
+        return pred_fms, fms_seq[1:] + [pred_fms], state
+
+    def infer(self, pred_fms, outputs=None):
+        # the heads that read one predicted frame alone, the batch may stack several time steps
+        # returns the outputs and the (full, low) resolution class maps the speed heads read, None where not computed
+        output_dict = dict()
+        rx, rx_low = None, None
+        if not self.lowres(outputs):
+            output_dict['seg_pred'], rx, depth_pred = self.fm_infer(pred_fms, with_depth=self.needs('depth_pred', outputs))
+            if depth_pred is not None:
+                output_dict['depth_pred'] = depth_pred
+        elif self.needs('depth_pred', outputs):
+            output_dict['depth_pred'] = self.depth_head(pred_fms[0])
+        if self.needs_lowres_map(outputs):
+            rx_low = self.lowres_infer(pred_fms)
+        output_dict.update(self.detect(pred_fms, self.detection_outputs, outputs))
+
+        rxs = (rx, rx_low)
+        output_dict.update(self.infer_events(rxs, outputs))
+        return output_dict, rxs
+
+    def slide(self, hidden, rxs):
+        # move the (full, low) class map windows the speed heads read on by one frame, dropping those not computed
+        return tuple(None if h is None or rx is None else torch.cat([h[:, self.args.classes:], rx], dim=1)
+                     for h, rx in zip(hidden, rxs))
+
+    def forward_next_step(self, fms_seq, action, with_encode=False, hidden=None, cell=None, training=True, action_var=None, outputs=None):
         # given the predicted feature maps for the next frame, do:
         # 1. detect vehicles on the feature maps
         # 2. infer semantic segmentation on the feature maps
         # 3. infer feature maps for the following frame
         # 4. predct events on the feature maps
-        output_dict = dict()
-        fms_seq[-1] = tile(fms_seq[-1], action)
-        pred_fms = self.feature_map_predictor(fms_seq)
+        # only the heads needed for outputs (see needs) are run
+        # cell carries the ConvLSTM state with --stateful-rollout
+        # hidden holds the (full, low) resolution class map windows, see encode
+        pred_fms, nx_feature_enc, cell = self.predict_fms(fms_seq, action, cell)
+        output_dict, rxs = self.infer(pred_fms, outputs)
+
+        hidden = self.slide(hidden, rxs)
+        for key, _, index in self.event_heads(['speed'], outputs):
+            output_dict[key] = self.speed_head(index)(hidden[index].detach())
 
-        output_dict['seg_pred'], rx, output_dict['depth_pred'] = self.fm_infer(pred_fms)
-        if self.args.use_detection:
-            output_dict['loc_pred'], output_dict['cls_pred'], output_dict['colls_with_prob'], output_dict["residual_pred"], output_dict["conf_pred"], output_dict["dim_pred"], output_dict["center_pred"] = self.detector(pred_fms)
+        return output_dict, nx_feature_enc, hidden, cell
 
-        nx_feature_enc = fms_seq[1:] + [pred_fms]
-        hidden = torch.cat([hidden[:, self.args.classes:, :, :], rx], dim=1)
+    def encode(self, x, action_var=None, feature_cache=None, outputs=None):
+        # the action-independent part of forward: encode the history frames once and
+        # tile the history actions onto all but the last frame's feature maps
+        fms_seq, hidden_seq, last_frame_seg, last_frame_depth, last_frame_fms = self.get_feature(x, feature_cache=feature_cache, with_depth=self.needs('depth_pred', outputs))
+        output_dict, fms_seq, hidden, state = self.encode_features(fms_seq, hidden_seq, action_var, outputs)
 
-        if self.args.use_collision:
-            output_dict['coll_prob'] = self.coll_layer(rx.detach())
-            # output_dict['coll_other_prob'] = self.coll_other_layer(rx.detach())
-            # output_dict['coll_vehicles_prob'] = self.coll_vehicle_layer(rx.detach())
-        if self.args.use_offroad:
-            output_dict['offroad_prob'] = self.offroad_layer(rx.detach())
-        if self.args.use_offlane:
-            output_dict['offlane_prob'] = self.offlane_layer(rx.detach())
-        if self.args.use_speed:
-            output_dict['speed'] = self.speed_layer(hidden.detach())
+        output_dict['seg_current'] = last_frame_seg
+        if last_frame_depth is not None:
+            output_dict["depth_current"] = last_frame_depth
+        return output_dict, fms_seq, hidden, state
+
+    def encode_features(self, fms_seq, hidden_seq, action_var=None, outputs=None):
+        # the part of encode past the backbone, from the feature maps and class maps of the history frames
+        # (as encode_frame gives them), also used by the exported planner (see planner.export_planner)
+        output_dict = self.detect(fms_seq[-1], ['loc_current', 'cls_current', 'coll_with_current', 'residual_current', 'conf_current', 'dim_current', 'center_current'], outputs)
 
-        return output_dict, nx_feature_enc, hidden, None
+        # the class maps of the history frames at full resolution, and at the scale of fms[0] for the low-resolution heads
+        hidden_low = None
+        if self.needs_lowres_map(outputs):
+            hidden_low = torch.cat([self.lowres_infer(fms) for fms in fms_seq], dim=1)
 
-    def forward(self, x, action, with_encode=False, hidden=None, cell=None, training=True, action_var=None):
+        fms_seq = tile_first(fms_seq, action_var)
+        # with --stateful-rollout the history frames before the latest one go through the ConvLSTM here, once
+        state = None
+        if self.args.stateful_rollout:
+            for fms in fms_seq[:-1]:
+                state = self.feature_map_predictor.step(fms, state)
+        return output_dict, fms_seq, (hidden_seq, hidden_low), state
+
+    def forward(self, x, action, with_encode=False, hidden=None, cell=None, training=True, action_var=None, outputs=None):
         # given the RGB observations of current frame and history frames, do:
         # 1. detect vehicles on the current frame & next frame
         # 2. infer semantic segmentation on the current frame & next frame
         # 3. infer feature maps for the next frame with LSTM
         # 4. predict events on the next frame
-        output_dict = dict()
-        fms_seq, hidden_seq, last_frame_seg, last_frame_depth, last_frame_fms = self.get_feature(x)
-
-        output_dict['seg_current'] = last_frame_seg
-        output_dict["depth_current"] = last_frame_depth
-
-        if self.args.use_detection:
-            output_dict['loc_current'], output_dict['cls_current'], output_dict['coll_with_current'], output_dict["residual_current"], output_dict["conf_current"], output_dict["dim_current"], output_dict["center_current"] = self.detector(last_frame_fms)
-        
-        fms_seq = tile_first(fms_seq, action_var)
-        output_dict_future, nx_feature_enc, hidden, _ = self.forward_next_step(fms_seq, action, hidden=hidden_seq)
+        output_dict, fms_seq, hidden_seq, state = self.encode(x, action_var, outputs=outputs)
+        output_dict_future, nx_feature_enc, hidden, state = self.forward_next_step(fms_seq, action, hidden=hidden_seq, cell=state, outputs=outputs)
 
         output_dict_all = dict(output_dict, **output_dict_future)  
 
-        return output_dict_all, nx_feature_enc, hidden, None
+        return output_dict_all, nx_feature_enc, hidden, state
 
 
 class ConvLSTMMulti(nn.Module):
@@ -186,46 +358,128 @@ class ConvLSTMMulti(nn.Module):
         logit = self.conv_lstm.guide_layer(enc.detach())
         return logit
 
-    # TODO: refactor this function
-    def forward(self, imgs, actions=None, hidden=None, cell=None, get_feature=False, training=True, action_var=None, next_obs=False, action_only=False):
-        # create dictionary to store outputs
-        # retinanet_loc_preds, retinanet_cls_preds = self.retinanet(imgs[:, 0, 6:9, :, :])
-        final_dict = dict()
+    def encode(self, imgs, action_var=None, feature_cache=None, with_guide=False, outputs=None):
+        # encode the observed history once, the result can be rolled out under any number of action sequences
+        # imgs: B x 1 x 3*frame_history_len x H x W, action_var: B x (frame_history_len-1) x num_total_act
+        # with_guide also returns the guidance logits of the latest frame (same as action_only=True)
+        # computed from the backbone features already at hand
+        history = self.conv_lstm.encode(imgs[:, 0, :, :, :], action_var, feature_cache=feature_cache, outputs=outputs)
+        if not with_guide:
+            return history
+        hidden = history[2][0][:, -self.args.classes:, :, :]
+        return history, self.conv_lstm.guide_layer(hidden.detach())
+
+    def rollout(self, history, actions, training=True, outputs=None):
+        # predict pred_step future frames for each action sequence in actions (N x pred_step x num_total_act)
+        # starting from an encoded history; a history of batch size 1 is shared by all N sequences
+        # outputs: the output keys to compute (see ConvLSTMNet.needs), None for all enabled by the flags
+        output_dict, fms_seq, hidden_seq, state = history
+        batch_size = actions.size(0)
+        expand = lambda t: t.expand(batch_size, *t.shape[1:]) if t.size(0) != batch_size else t
+        output_dict = {key: expand(value) for key, value in output_dict.items()}
+        # the history feature maps keep their batch size, the ConvLSTM cells broadcast them against the actions;
+        # forward_next_step writes into the sequence, keep the encoded history intact for reuse
+        fms_seq = list(fms_seq)
+        hidden = tuple(h if h is None else expand(h) for h in hidden_seq)
+
+        if self.args.batch_heads:
+            return self.rollout_batched(output_dict, fms_seq, hidden, state, actions, outputs)
 
-        if action_only:
-            return self.conv_lstm.act(imgs)
+        final_dict = dict()
+        output_dict_future, pred, hidden, cell = self.conv_lstm.forward_next_step(fms_seq, actions[:, 0, :], hidden=hidden, cell=state, training=training, outputs=outputs)
+        output_dict = dict(output_dict, **output_dict_future)
 
-        output_dict, pred, hidden, cell = self.conv_lstm(imgs[:, 0, :, :, :], actions[:, 0, :], hidden=hidden, cell=cell, training=training, action_var=action_var)
-        
         for key in output_dict.keys():
             final_dict[key] = [output_dict[key]]
 
         # combine the result for the current frame and the next future frame
-        final_dict['seg_pred'] = [output_dict['seg_current'], output_dict['seg_pred']]
-        final_dict["depth_pred"] = [output_dict["depth_current"], output_dict["depth_pred"]]
-
-        if self.args.use_detection:
-            final_dict['loc_pred'] = [output_dict['loc_current'], output_dict['loc_pred']]
-            final_dict['cls_pred'] = [output_dict['cls_current'], output_dict['cls_pred']]
-            final_dict['colls_with_prob'] = [output_dict['coll_with_current'], output_dict['colls_with_prob']]
-            '''
-            final_dict['residual_pred'] = [output_dict['residual_current'], output_dict['residual_pred']]
-            final_dict['conf_pred'] = [output_dict['conf_current'], output_dict['conf_pred']]
-            final_dict['dim_pred'] = [output_dict['dim_current'], output_dict['dim_pred']]
-            final_dict['center_pred'] = [output_dict['center_current'], output_dict['center_pred']]
-            '''
+        for key, current_key in [('seg_pred', 'seg_current'), ('depth_pred', 'depth_current'), ('loc_pred', 'loc_current'),
+                                 ('cls_pred', 'cls_current'), ('colls_with_prob', 'coll_with_current')]:
+            if key in output_dict and current_key in output_dict:
+                final_dict[key] = [output_dict[current_key], output_dict[key]]
+        '''
+        final_dict['residual_pred'] = [output_dict['residual_current'], output_dict['residual_pred']]
+        final_dict['conf_pred'] = [output_dict['conf_current'], output_dict['conf_pred']]
+        final_dict['dim_pred'] = [output_dict['dim_current'], output_dict['dim_pred']]
+        final_dict['center_pred'] = [output_dict['center_current'], output_dict['center_pred']]
+        '''
 
         # keep predicting for following future frames and append prediction into the dict
         for i in range(1, self.args.pred_step):
-            output_dict, pred, hidden, cell = self.conv_lstm.forward_next_step(pred, actions[:, i, :], with_encode=True, hidden=hidden, cell=cell, training=training, action_var=None)
+            output_dict, pred, hidden, cell = self.conv_lstm.forward_next_step(pred, actions[:, i, :], with_encode=True, hidden=hidden, cell=cell, training=training, action_var=None, outputs=outputs)
             for key in output_dict.keys():
                 final_dict[key].append(output_dict[key])
 
         for key in final_dict.keys():
             final_dict[key] = torch.stack(final_dict[key], dim=1)
-        
+
+        return final_dict
+
+    def rollout_start(self, history, batch_size):
+        # the state of a step-by-step rollout of batch_size action sequences from an encoded history, advanced by
+        # rollout_step; the frame heads of each predicted step are then at hand before the next one is predicted
+        output_dict, fms_seq, hidden_seq, state = history
+        hidden = tuple(h if h is None or h.size(0) == batch_size else h.expand(batch_size, *h.shape[1:]) for h in hidden_seq)
+        return list(fms_seq), hidden, state
+
+    def rollout_step(self, step_state, action, outputs=None):
+        # one predicted step of the sequences in step_state (as rollout does it), action: N x num_total_act
+        fms_seq, hidden, cell = step_state
+        output_dict, pred, hidden, cell = self.conv_lstm.forward_next_step(fms_seq, action, hidden=hidden, cell=cell, training=False, outputs=outputs)
+        return output_dict, (pred, hidden, cell)
+
+    def rollout_take(self, step_state, index, batch_size):
+        # keep the sequences index of a step-by-step rollout of batch_size sequences, the others are dropped
+        return take_batch(step_state, index, batch_size)
+
+    def rollout_batched(self, output_dict, fms_seq, hidden, state, actions, outputs=None):
+        # rollout with --batch-heads: only the ConvLSTM recurrence runs step by step, the heads then run
+        # once over all pred_step predicted frames stacked into the batch (N*pred_step, batch-major)
+        batch_size, pred_step = actions.size(0), self.args.pred_step
+        pred_seq = []
+        for i in range(pred_step):
+            pred_fms, fms_seq, state = self.conv_lstm.predict_fms(fms_seq, actions[:, i, :], state)
+            pred_seq.append(pred_fms)
+        pred_fms = [torch.stack(level, dim=1).flatten(0, 1) for level in zip(*pred_seq)]
+        output_future, rxs = self.conv_lstm.infer(pred_fms, outputs)
+        unstack = lambda t: t.view(batch_size, pred_step, *t.shape[1:])
+        final_dict = {key: unstack(value) for key, value in output_future.items()}
+
+        for key, _, index in self.conv_lstm.event_heads(['speed'], outputs):
+            # the speed head reads the segmentation of the frame_history_len latest frames, a window sliding over
+            # history + predictions; the windows overlap, so it stays a cheap per-step loop over the stacked rx
+            rx = unstack(rxs[index]).flatten(1, 2)
+            window = hidden[index].size(1)
+            seq = torch.cat([hidden[index], rx], dim=1)
+            speed = []
+            for i in range(pred_step):
+                begin = (i + 1) * self.args.classes
+                speed.append(self.conv_lstm.speed_head(index)(seq[:, begin: begin + window].detach()))
+            final_dict[key] = torch.stack(speed, dim=1)
+
+        # combine the result for the current frame with those of the future frames
+        for key, value in output_dict.items():
+            final_dict[key] = value.unsqueeze(1)
+        for key, current_key in [('seg_pred', 'seg_current'), ('depth_pred', 'depth_current'), ('loc_pred', 'loc_current'),
+                                 ('cls_pred', 'cls_current'), ('colls_with_prob', 'coll_with_current')]:
+            if key in output_future and current_key in output_dict:
+                final_dict[key] = torch.cat([output_dict[current_key].unsqueeze(1), final_dict[key]], dim=1)
+
         return final_dict
 
+    def forward(self, imgs, actions=None, hidden=None, cell=None, get_feature=False, training=True, action_var=None, next_obs=False, action_only=False, outputs=None):
+        # retinanet_loc_preds, retinanet_cls_preds = self.retinanet(imgs[:, 0, 6:9, :, :])
+        if action_only:
+            return self.conv_lstm.act(imgs)
+
+        history = self.encode(imgs, action_var, outputs=outputs)
+        return self.rollout(history, actions, training=training, outputs=outputs)
+
+
+def unwrap_model(net):
+    # DataParallel only splits forward(), the encode / rollout API is called on the wrapped module
+    return net.module if isinstance(net, nn.DataParallel) else net
+
 
 def init_models(args):
     train_net = ConvLSTMMulti(args)
@@ -248,10 +502,11 @@ def init_models(args):
         train_net.conv_lstm.freeze_bn()
     '''
 
-    if torch.cuda.is_available():
-        train_net = train_net.cuda()
-        if args.data_parallel:
-            train_net = torch.nn.DataParallel(train_net)
+    train_net = train_net.to(args.device)
+    if args.channels_last:
+        train_net = train_net.to(memory_format=torch.channels_last)
+    if args.data_parallel and args.device == 'cuda':
+        train_net = torch.nn.DataParallel(train_net)
     
     if args.optim == 'Adam':
         optimizer = optim.Adam(train_net.parameters(), lr=args.lr, amsgrad=True)
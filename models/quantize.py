@@ -0,0 +1,50 @@
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+from utils.util import norm_image
+
+
+def calibration_frames(spc_buffer, num_frames, batch_size=8):
+    # the latest observed frame of num_frames samples drawn from an SPCBuffer, normalized as the backbone sees them
+    frames = []
+    while len(frames) * batch_size < num_frames:
+        obs = spc_buffer.sample(batch_size)['obs_batch'][:, 0, -3:]
+        frames.append(norm_image(torch.from_numpy(np.array(obs)).float()))
+    return torch.cat(frames)[:num_frames]
+
+
+def quantize_fpn(fpn, frames, backend='x86', batch_size=8):
+    '''
+    Post-training static INT8 quantization of an FPN backbone, a quantized copy is returned:
+    Conv+BN+ReLU fused (see FPN.fuse_model), activation ranges calibrated on frames (N x 3 x H x W),
+    weights per-channel INT8. The quantized backbone runs on the CPU only.
+    '''
+    torch.backends.quantized.engine = backend
+    fpn = copy.deepcopy(fpn).cpu().eval()
+    fpn.fuse_model()
+    fpn.qconfig = quantization.get_default_qconfig(backend)
+    quantization.prepare(fpn, inplace=True)
+    with torch.no_grad():
+        for begin in range(0, frames.size(0), batch_size):
+            fpn(frames[begin: begin + batch_size].cpu())
+    return quantization.convert(fpn, inplace=True)
+
+
+def quantize_heads(net):
+    # dynamic INT8 quantization of the Linear layers of the guidance and speed heads (net is the ConvLSTMMulti, changed in place);
+    # the ConvLSTM gates and the fused event heads are convolutions and batched matmuls, dynamic quantization does not cover them
+    conv_lstm = net.conv_lstm
+    for name in ['guide_layer', 'speed_layer', 'lowres_speed_layer']:
+        if hasattr(conv_lstm, name):
+            setattr(conv_lstm, name, quantization.quantize_dynamic(getattr(conv_lstm, name), {nn.Linear}, dtype=torch.qint8))
+    return net
+
+
+def quantize_backbone(net, frames, backend='x86', with_heads=False):
+    # plan with an INT8 backbone: net (ConvLSTMMulti, on the CPU) gets a quantized copy of its FPN, in place
+    net.conv_lstm.fpn = quantize_fpn(net.conv_lstm.fpn, frames, backend)
+    if with_heads:
+        quantize_heads(net)
+    return net
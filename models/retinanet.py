@@ -5,6 +5,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 import math
 import torch.nn.init as init
+from torch.ao.quantization import QuantStub, DeQuantStub, fuse_modules
 
 
 def one_hot_embedding(labels, num_classes):
@@ -40,23 +41,35 @@ class Bottleneck(nn.Module):
                 nn.Conv2d(in_planes, self.expansion*planes, kernel_size=1, stride=stride, bias=False),
                 nn.BatchNorm2d(self.expansion*planes)
             )
+        # module forms of the relus and the residual add, so that the block can be fused and quantized (see fuse_model)
+        self.relu1 = nn.ReLU(inplace=True)
+        self.relu2 = nn.ReLU(inplace=True)
+        self.skip_add = nn.quantized.FloatFunctional()
 
     def forward(self, x):
-        out = F.relu(self.bn1(self.conv1(x)), inplace=True)
-        out = F.relu(self.bn2(self.conv2(out)), inplace=True)
+        out = self.relu1(self.bn1(self.conv1(x)))
+        out = self.relu2(self.bn2(self.conv2(out)))
         out = self.bn3(self.conv3(out))
-        out += self.downsample(x)
-        out = F.relu(out, inplace=True)
-        return out
+        return self.skip_add.add_relu(out, self.downsample(x))
+
+    def fuse_model(self):
+        # fold the BatchNorms into the convs (Conv+BN+ReLU), for inference only
+        fuse_modules(self, [['conv1', 'bn1', 'relu1'], ['conv2', 'bn2', 'relu2'], ['conv3', 'bn3']], inplace=True)
+        if len(self.downsample) > 0:
+            fuse_modules(self.downsample, [['0', '1']], inplace=True)
 
 
 class FPN(nn.Module):
-    def __init__(self, block, num_blocks):
+    def __init__(self, block, num_blocks, num_levels=5):
         super(FPN, self).__init__()
         self.in_planes = 64
+        # forward returns the first num_levels of (p3, p4, p5, p6, p7)
+        # p3 needs p4 and p5 on the top-down path, only the p6/p7 branches can be skipped
+        self.num_levels = num_levels
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3, bias=False)
         self.bn1 = nn.BatchNorm2d(64)
+        self.relu1 = nn.ReLU(inplace=True)
 
         # Bottom-up layers
         self.layer1 = self._make_layer(block,  64, num_blocks[0], stride=1)
@@ -65,8 +78,10 @@ class FPN(nn.Module):
         self.layer4 = self._make_layer(block, 512, num_blocks[3], stride=2)
         # self.conv50 = nn.Conv2d(1024, 256, kernel_size=3, stride=2, padding=1)
         # self.conv60 = nn.Conv2d(256, 256, kernel_size=3, stride=2, padding=1)
-        self.conv6 = nn.Conv2d(2048, 256, kernel_size=3, stride=2, padding=1)
-        self.conv7 = nn.Conv2d( 256, 256, kernel_size=3, stride=2, padding=1)
+        if self.num_levels > 3:
+            self.conv6 = nn.Conv2d(2048, 256, kernel_size=3, stride=2, padding=1)
+        if self.num_levels > 4:
+            self.conv7 = nn.Conv2d( 256, 256, kernel_size=3, stride=2, padding=1)
 
         # Lateral layers
         self.latlayer1 = nn.Conv2d(2048, 256, kernel_size=1, stride=1, padding=0)
@@ -80,6 +95,19 @@ class FPN(nn.Module):
         self.toplayer1 = nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1)
         self.toplayer2 = nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1)
 
+        # the float <-> quantized boundaries and the top-down adds of a statically quantized backbone
+        # (models/quantize.py), identities and plain adds otherwise
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+        self.upsample_adds = nn.ModuleList([nn.quantized.FloatFunctional() for _ in range(2)])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the full model also carry the p6/p7 branches skipped here
+        skipped = [name for name, level in [('conv6', 4), ('conv7', 5)] if self.num_levels < level]
+        for key in [key for key in state_dict.keys() if key.startswith(prefix) and key[len(prefix):].split('.')[0] in skipped]:
+            del state_dict[key]
+        super(FPN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _make_layer(self, block, planes, num_blocks, stride):
         strides = [stride] + [1]*(num_blocks-1)
         layers = []
@@ -88,7 +116,13 @@ class FPN(nn.Module):
             self.in_planes = planes * block.expansion
         return nn.Sequential(*layers)
 
-    def _upsample_add(self, x, y):
+    def fuse_model(self):
+        fuse_modules(self, [['conv1', 'bn1', 'relu1']], inplace=True)
+        for module in self.modules():
+            if isinstance(module, Bottleneck):
+                module.fuse_model()
+
+    def _upsample_add(self, x, y, add):
         '''Upsample and add two feature maps.
 
         Args:
@@ -110,30 +144,35 @@ class FPN(nn.Module):
         So we choose bilinear upsample which supports arbitrary output sizes.
         '''
         _,_,H,W = y.size()
-        return F.interpolate(x, size=(H,W), mode='bilinear') + y
+        return add.add(F.interpolate(x, size=(H,W), mode='bilinear'), y)
 
     def forward(self, x):
         # Bottom-up
-        c1 = F.relu(self.bn1(self.conv1(x)))
+        c1 = self.relu1(self.bn1(self.conv1(self.quant(x))))
         c1 = F.max_pool2d(c1, kernel_size=3, stride=2, padding=1)
         c2 = self.layer1(c1)
         c3 = self.layer2(c2)
         c4 = self.layer3(c3)
         c5 = self.layer4(c4)
-        p6 = self.conv6(c5)
-        p7 = self.conv7(F.relu(p6))
         # Top-down
         p5 = self.latlayer1(c5)
-        p4 = self._upsample_add(p5, self.latlayer2(c4))
+        p4 = self._upsample_add(p5, self.latlayer2(c4), self.upsample_adds[0])
         p4 = self.toplayer1(p4)
-        p3 = self._upsample_add(p4, self.latlayer3(c3))
+        p3 = self._upsample_add(p4, self.latlayer3(c3), self.upsample_adds[1])
         p3 = self.toplayer2(p3)
+        if self.num_levels <= 3:
+            return tuple(map(self.dequant, (p3, p4, p5)[:self.num_levels]))
+
+        p6 = self.conv6(c5)
+        if self.num_levels == 4:
+            return tuple(map(self.dequant, (p3, p4, p5, p6)))
+        p7 = self.conv7(F.relu(p6))
 
-        return p3, p4, p5, p6, p7
+        return tuple(map(self.dequant, (p3, p4, p5, p6, p7)))
 
 
-def FPN50():
-    return FPN(Bottleneck, [3,4,6,3])
+def FPN50(num_levels=5):
+    return FPN(Bottleneck, [3,4,6,3], num_levels)
 
 
 class Header3D(nn.Module):
@@ -178,7 +217,8 @@ class RetinaNet_Header(nn.Module):
         # We suggest to disable the 3D detection head for now because it's not mature enough
         self.thrd_head = Header3D(self.num_classes, self.bins, self.num_anchors)
 
-    def forward(self, fms):
+    def forward(self, fms, with_box=True, with_coll=True, with_3d=True):
+        # the box (loc_head, cls_head), collision (coll_head) and 3D (thrd_head) outputs are None when not asked for
         loc_preds = []
         cls_preds = []
         coll_preds = []
@@ -187,27 +227,32 @@ class RetinaNet_Header(nn.Module):
         dim_preds = []
         center_preds = []
         for fm in fms:
-            loc_pred = self.loc_head(fm)
-            cls_pred = self.cls_head(fm)
-            coll_pred = self.coll_head(fm)
-            conf_pred, residual_pred, dim_pred, center_pred = self.thrd_head(fm)
-            loc_pred = loc_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, 4)                 # [N, 9*4,H,W] -> [N,H,W, 9*4] -> [N,H*W*9, 4]
-            cls_pred = cls_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, self.num_classes)  # [N,9*20,H,W] -> [N,H,W,9*20] -> [N,H*W*9,20]
-            coll_pred = coll_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, 2) 
-            conf_pred = conf_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, self.bins)
-            residual_pred = residual_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, self.bins*2)
-            dim_pred = dim_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, 3)
-            center_pred = center_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, 3)
-      
-            loc_preds.append(loc_pred)
-            cls_preds.append(cls_pred)
-            coll_preds.append(coll_pred)
-            residual_preds.append(residual_pred)
-            conf_preds.append(conf_pred)
-            dim_preds.append(dim_pred)
-            center_preds.append(center_pred)
-        
-        return torch.cat(loc_preds, 1), torch.cat(cls_preds, 1), torch.cat(coll_preds, 1), torch.cat(residual_preds, 1), torch.cat(conf_preds, 1), torch.cat(dim_preds, 1), torch.cat(center_preds, 1)
+            if with_box:
+                loc_pred = self.loc_head(fm)
+                cls_pred = self.cls_head(fm)
+                loc_pred = loc_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, 4)                 # [N, 9*4,H,W] -> [N,H,W, 9*4] -> [N,H*W*9, 4]
+                cls_pred = cls_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, self.num_classes)  # [N,9*20,H,W] -> [N,H,W,9*20] -> [N,H*W*9,20]
+                loc_preds.append(loc_pred)
+                cls_preds.append(cls_pred)
+
+            if with_coll:
+                coll_pred = self.coll_head(fm)
+                coll_pred = coll_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, 2) 
+                coll_preds.append(coll_pred)
+
+            if with_3d:
+                conf_pred, residual_pred, dim_pred, center_pred = self.thrd_head(fm)
+                conf_pred = conf_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, self.bins)
+                residual_pred = residual_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, self.bins*2)
+                dim_pred = dim_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, 3)
+                center_pred = center_pred.permute(0,2,3,1).contiguous().view(fm.size(0), -1, 3)
+                residual_preds.append(residual_pred)
+                conf_preds.append(conf_pred)
+                dim_preds.append(dim_pred)
+                center_preds.append(center_pred)
+
+        cat = lambda preds: torch.cat(preds, 1) if len(preds) > 0 else None
+        return cat(loc_preds), cat(cls_preds), cat(coll_preds), cat(residual_preds), cat(conf_preds), cat(dim_preds), cat(center_preds)
 
     def get_cen(self):
         # get the center coordinates of target anchors
@@ -0,0 +1,128 @@
+import os
+import json
+import torch
+import torch.nn as nn
+from models import unwrap_model
+
+
+class FrameEncoder(nn.Module):
+    # one history frame -> its feature maps, its class map and the guidance logits read from it (see ConvLSTMNet.encode_frame)
+    def __init__(self, net):
+        super(FrameEncoder, self).__init__()
+        self.conv_lstm = net.conv_lstm
+
+    def forward(self, frame):
+        fms, hidden, _ = self.conv_lstm.encode_frame(frame)
+        return tuple(fms) + (hidden, self.conv_lstm.guide_layer(hidden))
+
+
+class PlanningCost(nn.Module):
+    # the encoded history frames (feature maps and class map of each, flattened), the history actions and the
+    # action candidates -> the costs of ActionSampleManager.estimate_cost, for a fixed number of candidates
+    def __init__(self, net, manager):
+        super(PlanningCost, self).__init__()
+        self.net, self.manager = net, manager
+        self.frame_len = net.conv_lstm.num_levels + 1
+
+    def forward(self, *inputs):
+        features, action_var, actions = inputs[:-2], inputs[-2], inputs[-1]
+        frames = [features[i: i + self.frame_len] for i in range(0, len(features), self.frame_len)]
+        fms_seq = [list(frame[:-1]) for frame in frames]
+        hidden_seq = torch.cat([frame[-1] for frame in frames], dim=1)
+        history = self.net.conv_lstm.encode_features(fms_seq, hidden_seq, action_var, outputs=self.manager.cost_outputs())
+        return self.manager.estimate_cost(self.net, history, actions)
+
+
+def export_planner(net, manager, path, onnx=False):
+    '''
+    Trace the planning of net (ConvLSTMMulti) into path: encoder.pt encodes one history frame and gives the guidance
+    logits, planner.pt rolls out manager.cand_num action candidates of pred_step steps and computes their costs.
+    The heads, flags and shapes are fixed at export time. With onnx, the same graphs are also written as
+    encoder.onnx / planner.onnx. Returns the largest difference between the traced and the eager guidance logits
+    and costs, on frames and candidates drawn after tracing.
+    Tracing keeps the Python branches taken on the export inputs, so the rollouts whose branches follow the costs
+    (--prune-rollout, and the two-stage SAS cost without --batch-heads, see estimate_cost_steps) are not exported.
+    '''
+    net = unwrap_model(net).eval()
+    args = manager.args
+    if args.prune_rollout or (manager.instance_cost() and not args.batch_heads):
+        raise ValueError("the pruning / top_k decisions of --prune-rollout and of the two-stage SAS cost depend on the costs "
+                         "and cannot be traced, export without --prune-rollout (and with --batch-heads for SAS)")
+    device = next(net.parameters()).device
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    frame = torch.zeros(1, 3, args.frame_height, args.frame_width, device=device)
+    action_var = torch.zeros(1, args.frame_history_len - 1, args.num_total_act, device=device)
+    actions = torch.rand(manager.cand_num, args.pred_step, args.num_total_act, device=device) * 2 - 1
+    encoder, planning_cost = FrameEncoder(net), PlanningCost(net, manager)
+    with torch.no_grad():
+        # every frame needs its own tensors, the tracer would read repeated ones from the first input
+        features = tuple(t.clone() for _ in range(args.frame_history_len) for t in encoder(frame)[:-1])
+        inputs = features + (action_var, actions)
+        # the eager run also fills the caches of the ConvLSTM cells, the trace keeps their weight splits as constants
+        planning_cost(*inputs)
+        traced_encoder = torch.jit.trace(encoder, frame)
+        traced_planner = torch.jit.trace(planning_cost, inputs)
+
+        # validate on other frames, history actions and candidates than the trace inputs, so that a graph
+        # specialized to them (a shape or a branch taken) shows up as a difference
+        frames = [torch.rand(1, 3, args.frame_height, args.frame_width, device=device) * 2 - 1 for _ in range(args.frame_history_len)]
+        action_var = torch.rand(1, args.frame_history_len - 1, args.num_total_act, device=device) * 2 - 1
+        actions = torch.rand(manager.cand_num, args.pred_step, args.num_total_act, device=device) * 2 - 1
+        outputs = []
+        for frame_encoder, planner in [(encoder, planning_cost), (traced_encoder, traced_planner)]:
+            encoded = [frame_encoder(frame) for frame in frames]
+            features = tuple(t for feature in encoded for t in feature[:-1])
+            outputs.append([encoded[-1][-1]] + list(planner(*(features + (action_var, actions)))))
+        diff = max((traced - eager).abs().max().item() for eager, traced in zip(*outputs))
+
+    torch.jit.save(traced_encoder, os.path.join(path, 'encoder.pt'))
+    torch.jit.save(traced_planner, os.path.join(path, 'planner.pt'))
+    with open(os.path.join(path, 'planner.json'), 'w') as f:
+        json.dump({'cand_num': manager.cand_num, 'pred_step': args.pred_step, 'frame_history_len': args.frame_history_len,
+                   'num_levels': net.conv_lstm.num_levels}, f)
+
+    if onnx:
+        feature_names = ['frame{}_{}'.format(i, name) for i in range(args.frame_history_len)
+                         for name in ['p{}'.format(level + 3) for level in range(net.conv_lstm.num_levels)] + ['seg']]
+        with torch.no_grad():
+            torch.onnx.export(encoder, (frame,), os.path.join(path, 'encoder.onnx'), dynamo=False,
+                              input_names=['frame'], output_names=feature_names[:net.conv_lstm.num_levels + 1] + ['guide'])
+            torch.onnx.export(planning_cost, inputs, os.path.join(path, 'planner.onnx'), dynamo=False,
+                              input_names=feature_names + ['action_var', 'actions'], output_names=['cost', 'ins_cost'])
+    return diff
+
+
+class PlannerEngine(nn.Module):
+    '''
+    Runs the planning graphs written by export_planner, on the CPU by default. encode and estimate_cost stand in for
+    ConvLSTMMulti.encode and ActionSampleManager.estimate_cost, so ActionSampleManager.sample_action takes it as the net.
+    '''
+    def __init__(self, path, device='cpu'):
+        super(PlannerEngine, self).__init__()
+        self.encoder = torch.jit.load(os.path.join(path, 'encoder.pt'), map_location=device)
+        self.planner = torch.jit.load(os.path.join(path, 'planner.pt'), map_location=device)
+        with open(os.path.join(path, 'planner.json')) as f:
+            self.config = json.load(f)
+
+    def encode(self, imgs, action_var=None, feature_cache=None, with_guide=False, outputs=None):
+        # imgs: 1 x 1 x 3*frame_history_len x H x W, outputs are fixed at export time
+        # with a feature_cache (BufferManager.FeatureCache) frames encoded on earlier steps are reused
+        features = []
+        for fidx in range(self.config['frame_history_len']):
+            feature = None if feature_cache is None else feature_cache.get(feature_cache.window[fidx])
+            if feature is None:
+                feature = self.encoder(imgs[:, 0, 3*fidx: 3*(fidx+1), :, :])
+                if feature_cache is not None:
+                    feature_cache.put(feature_cache.window[fidx], feature)
+            features.append(feature)
+        history = ([t for feature in features for t in feature[:-1]], action_var)
+        if not with_guide:
+            return history
+        return history, features[-1][-1]
+
+    def estimate_cost(self, history, actions):
+        features, action_var = history
+        assert actions.size(0) == self.config['cand_num'] and actions.size(1) == self.config['pred_step']
+        return self.planner(*features, action_var, actions)
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from utils import norm_image
+
+
+class BatchPrefetcher:
+    '''
+    Prepare the next training batches in the background while the current step computes.
+    The numpy gather (and bbox anchor encoding) runs in a thread pool, the host->device copies
+    are issued from pinned memory on a side CUDA stream. On the CPU batches are plain CPU tensors.
+
+    The buffer must not be written while a prefetcher is active, so create one per train_spn call
+    and only ask for as many batches as will be consumed.
+    '''
+    def __init__(self, spc_buffer, batch_size, num_batches, num_prefetch=2, num_workers=2):
+        self.spc_buffer = spc_buffer
+        self.batch_size = batch_size
+        self.num_left = num_batches
+        self.num_prefetch = max(1, num_prefetch)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, num_workers))
+        # batches go to the device of the run (args.device)
+        self.device = torch.device(spc_buffer.args.device)
+        self.stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+        self.queue = []
+        self.slot = 0
+        for _ in range(min(self.num_prefetch, self.num_left)):
+            self._submit()
+
+    def _submit(self):
+        # indices are drawn on the calling thread so the sampled sequence stays reproducible
+        assert self.spc_buffer.can_sample(self.batch_size)
+        indices = self.spc_buffer._sample_indices(self.batch_size)
+        self.queue.append(self.pool.submit(self._prepare, indices, self.slot))
+        self.slot = (self.slot + 1) % self.num_prefetch
+        self.num_left -= 1
+
+    def _to_device(self, array):
+        tensor = torch.from_numpy(array)
+        # float16 arrays (actions, speeds, depths) stay float16, the model and the losses cast them on the device
+        keep = tensor.dtype in (torch.float, torch.float16)
+        if self.stream is None:
+            # the slot arrays are reused, so make sure the batch owns its memory
+            return tensor.clone() if keep else tensor.float()
+        tensor = tensor.to(self.device, non_blocking=True)
+        return tensor if keep else tensor.float()
+
+    def _prepare(self, indices, slot):
+        target = self.spc_buffer._encode_sample(indices, slot)
+        event = None
+        if self.stream is None:
+            target = self._encode(target)
+        else:
+            with torch.cuda.stream(self.stream):
+                target = self._encode(target)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            # the slot may be refilled once the copies out of its pinned arrays are done
+            event.synchronize()
+        return target, event
+
+    def _encode(self, target):
+        # same conversion as train.encode_target, done on the device the batch ends up on
+        for key in target.keys():
+            if key == 'original_bboxes':
+                continue
+            target[key] = self._to_device(target[key])
+            if key == 'obs_batch':
+                target[key] = norm_image(target[key])
+        return target
+
+    def next(self):
+        target, event = self.queue.pop(0).result()
+        if event is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_event(event)
+            for key in target.keys():
+                if torch.is_tensor(target[key]):
+                    target[key].record_stream(current_stream)
+        if self.num_left > 0:
+            self._submit()
+        return target
+
+    def close(self):
+        for future in self.queue:
+            future.cancel()
+        self.queue = []
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,27 @@
+# the args of the helper benchmarks: the training parser (args.init_parser / post_processing), so that every flag the
+# code reads has its default, with the settings of an untrained-model benchmark as defaults on top; scripts add their
+# own flags and per-script defaults, e.g.
+#     parser = benchmark_parser("benchmark ...", device='cpu')
+#     parser.add_argument('--steps', type=int, default=20)
+#     args = parse_benchmark_args(parser)
+import argparse
+from args import init_parser, post_processing
+
+
+# 4 semantic classes, the frame event and speed heads planning reads, and a fixed candidate seed
+BENCHMARK_DEFAULTS = dict(classes=4, use_collision=True, use_offroad=True, use_offlane=True, use_speed=True,
+                          sample_with_collision=True, sample_with_offroad=True, sample_with_offlane=True, sample_seed=0)
+
+
+def benchmark_parser(description, **defaults):
+    parser = argparse.ArgumentParser(description=description)
+    init_parser(parser)
+    parser.add_argument('--frame-size', type=int, default=256, help="height and width of the frames")
+    parser.set_defaults(**dict(BENCHMARK_DEFAULTS, **defaults))
+    return parser
+
+
+def parse_benchmark_args(parser, argv=None):
+    args = post_processing(parser.parse_args(argv))
+    args.frame_height = args.frame_width = args.frame_size
+    return args
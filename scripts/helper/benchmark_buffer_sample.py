@@ -0,0 +1,67 @@
+# compare the latency of drawing training start indices from SPCBuffer:
+# the old rejection loop (random candidate + done-window check + uniqueness check) vs. the valid-start index
+# usage (from scripts/): python helper/benchmark_buffer_sample.py --sizes 20000 200000
+import sys
+import time
+import random
+import numpy as np
+
+sys.path.append("..")
+from spcbuffer import SPCBuffer
+from benchmark_args import benchmark_parser, parse_benchmark_args
+
+
+# only the bookkeeping arrays matter for index sampling, so frames are kept tiny
+parser = benchmark_parser("benchmark SPCBuffer index sampling", frame_size=8, device='cpu')
+parser.add_argument('--sizes', type=int, nargs='+', default=[20000, 200000])
+parser.add_argument('--min-epi-len', type=int, default=15, help="short episodes make the rejection loop spin")
+parser.add_argument('--max-epi-len', type=int, default=40)
+parser.add_argument('--repeat', type=int, default=200)
+args = parse_benchmark_args(parser)
+
+
+def make_buffer(size):
+    args.buffer_size = size
+    buf = SPCBuffer(args)
+    buf.done = np.zeros([size], dtype=np.int8)
+    pos = 0
+    while pos < size:
+        pos += np.random.randint(args.min_epi_len, args.max_epi_len)
+        if pos < size:
+            buf.done[pos] = 1
+    buf.num_in_buffer = size
+    buf.next_idx = 0
+    buf.last_idx = size - 1
+    buf._rebuild_valid_start()
+    return buf
+
+
+def legacy_sample(buf, batch_size):
+    # the rejection sampler SPCBuffer used before the valid-start index
+    def sample_done(idx):
+        if idx < 10 or idx >= buf.num_in_buffer - buf.args.pred_step - 10:
+            return False
+        done_list = buf.done[idx - buf.args.frame_history_len + 1: idx + buf.args.pred_step + 1]
+        return np.sum(done_list) < 1.0
+
+    res = []
+    while len(res) < batch_size:
+        candidate = random.randint(10, buf.num_in_buffer - 10)
+        if candidate not in res and sample_done(candidate):
+            res.append(candidate)
+    return res
+
+
+def timeit(func):
+    start = time.time()
+    for _ in range(args.repeat):
+        func()
+    return (time.time() - start) / args.repeat * 1000
+
+
+for size in args.sizes:
+    buf = make_buffer(size)
+    legacy_ms = timeit(lambda: legacy_sample(buf, args.batch_size))
+    index_ms = timeit(lambda: buf._sample_indices(args.batch_size))
+    print("buffer {:>8d} | valid starts {:>7d} | rejection loop {:.3f} ms | valid index {:.3f} ms | speedup {:.1f}x".format(
+        size, int(buf.valid_start.sum()), legacy_ms, index_ms, legacy_ms / index_ms))
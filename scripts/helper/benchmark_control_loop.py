@@ -0,0 +1,67 @@
+# measure the planning control-loop rate (ActionSampleManager.sample_action per env step) of an untrained model:
+# the old two-pass step (guidance forward with action_only=True, then the planning forward) vs. the fused
+# single backbone pass, both with and without the per-episode feature cache
+# usage (from scripts/): python helper/benchmark_control_loop.py --frame-size 256 --steps 20
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.append("..")
+from benchmark_args import benchmark_parser, parse_benchmark_args
+from models.model import ConvLSTMMulti
+from actionsampler import ActionSampleManager
+from manager import BufferManager
+from utils.util import norm_image, generate_guide_grid, PiecewiseSchedule
+
+
+parser = benchmark_parser("benchmark the planning control loop")
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--warmup', type=int, default=2)
+args = parse_benchmark_args(parser)
+device = torch.device(args.device)
+net = ConvLSTMMulti(args).to(device).eval()
+manager = ActionSampleManager(args, generate_guide_grid(args.bin_divide))
+exploration = PiecewiseSchedule([(0, 0.0)], outside_value=0.0)
+action_var = torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, args.frame_history_len - 1, 1).float()
+
+
+def legacy_step(obs, obs_var, feature_cache):
+    # the guidance forward ran the backbone on the latest frame once more before planning
+    with torch.no_grad():
+        x = norm_image(torch.from_numpy(np.expand_dims(obs.transpose(2, 0, 1), axis=0).copy()).float().to(device))
+        p = F.softmax(net(x, action_only=True)[0] / args.temperature, dim=-1).cpu().numpy()
+        imgs = norm_image(obs_var.to(device))
+        imgs = imgs.view(1, 1, *imgs.size()[-3:])
+        history = net.encode(imgs, action_var.to(device), feature_cache=feature_cache)
+    return manager._sample_action(p, net, history, manager.guides)
+
+
+def fused_step(obs, obs_var, feature_cache):
+    return manager.sample_action(net, obs, obs_var, action_var, exploration, 0, feature_cache=feature_cache)
+
+
+def run(step_func, use_cache):
+    obs_buffer = BufferManager.ObsBuffer(args.frame_history_len)
+    feature_cache = BufferManager.FeatureCache(args.frame_history_len) if use_cache else None
+    for i in range(args.warmup + args.steps):
+        if i == args.warmup:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+        obs = np.random.randint(0, 255, (args.frame_height, args.frame_width, 3)).astype(np.uint8)
+        obs_var = torch.from_numpy(obs_buffer.store_frame(obs)).unsqueeze(0).float()
+        if feature_cache is not None:
+            feature_cache.store_frame(i)
+        step_func(obs, obs_var, feature_cache)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return args.steps / (time.time() - start)
+
+
+for use_cache in [False, True]:
+    legacy_hz = run(legacy_step, use_cache)
+    fused_hz = run(fused_step, use_cache)
+    print("{} | feature cache {:<5} | two-pass {:.2f} Hz | fused {:.2f} Hz | speedup {:.2f}x".format(
+        device, str(use_cache), legacy_hz, fused_hz, fused_hz / legacy_hz))
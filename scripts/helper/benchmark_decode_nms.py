@@ -0,0 +1,66 @@
+# compare decoding the detection outputs of all predicted frames:
+# the per-frame DataEncoder.decode loop on CPU (as evaluate.py used to do) vs. the batched DataEncoder.decode_many
+# usage (from scripts/): python helper/benchmark_decode_nms.py --num-boxes 100 1000 5000
+import sys
+import time
+import argparse
+import torch
+
+sys.path.append("..")
+from utils.dataset import DataEncoder
+
+
+parser = argparse.ArgumentParser(description="benchmark detection decoding + NMS")
+parser.add_argument('--num-boxes', type=int, nargs='+', default=[100, 1000, 5000], help="boxes above the score threshold per frame")
+parser.add_argument('--pred-step', type=int, default=10)
+parser.add_argument('--frame-width', type=int, default=256)
+parser.add_argument('--frame-height', type=int, default=256)
+parser.add_argument('--repeat', type=int, default=3)
+bench_args = parser.parse_args()
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+input_size = (bench_args.frame_width, bench_args.frame_height)
+encoder = DataEncoder()
+num_anchors = encoder._get_anchor_boxes(input_size).size(0)
+
+
+def make_outputs(num_boxes):
+    # predictions of pred_step + 1 frames with exactly $num_boxes anchors scored above the 0.5 threshold
+    frames = bench_args.pred_step + 1
+    loc_preds = torch.randn(frames, num_anchors, 4) * 0.2
+    cls_preds = torch.full((frames, num_anchors, 1), -5.0)
+    for i in range(frames):
+        ids = torch.randperm(num_anchors)[:num_boxes]
+        cls_preds[i, ids, 0] = torch.rand(num_boxes) * 4 + 0.1
+    return loc_preds.to(device), cls_preds.to(device)
+
+
+def legacy(loc_preds, cls_preds):
+    loc_preds, cls_preds = loc_preds.cpu(), cls_preds.cpu()
+    return [encoder.decode(loc_preds[i], cls_preds[i], input_size=input_size) for i in range(loc_preds.size(0))]
+
+
+def batched(loc_preds, cls_preds):
+    res = encoder.decode_many(loc_preds, cls_preds, input_size=input_size)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return res
+
+
+def timeit(func, *inputs):
+    func(*inputs)
+    start = time.time()
+    for _ in range(bench_args.repeat):
+        func(*inputs)
+    return (time.time() - start) / bench_args.repeat * 1000
+
+
+print("device: {} | frames: {} | anchors: {}".format(device, bench_args.pred_step + 1, num_anchors))
+for num_boxes in bench_args.num_boxes:
+    inputs = make_outputs(num_boxes)
+    legacy_ms = timeit(legacy, *inputs)
+    batched_ms = timeit(batched, *inputs)
+    kept_legacy = sum(boxes.view(-1, 4).size(0) for boxes, _, _ in legacy(*inputs))
+    kept_batched = int(batched(*inputs)[3].sum())
+    print("boxes {:>5d} | per-frame loop {:9.1f} ms | batched {:9.1f} ms | speedup {:5.1f}x | kept {} / {}".format(
+        num_boxes, legacy_ms, batched_ms, legacy_ms / batched_ms, kept_legacy, kept_batched))
@@ -0,0 +1,123 @@
+# step time and peak memory with and without --amp, on an untrained model and random data shaped like the replay
+# batches (actions, speeds and depths float16 as the SPCBuffer stores them): a training step as Trainer.train_spn
+# runs it (forward under autocast, FP32 losses, loss scaling with fp16) and a planning step (ActionSampleManager.sample_action)
+# every setting runs in a fresh process, so that on the CPU the peak memory (max RSS) is its own
+# usage (from scripts/): python helper/benchmark_mixed_precision.py --frame-size 256 --batch-sizes 24 --amp-modes off bf16
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import numpy as np
+import torch
+import torch.nn as nn
+
+sys.path.append("..")
+from benchmark_args import benchmark_parser, parse_benchmark_args
+from models.model import ConvLSTMMulti
+from actionsampler import ActionSampleManager
+from utils.util import norm_image, generate_guide_grid, PiecewiseSchedule, amp_autocast
+
+
+parser = benchmark_parser("benchmark mixed precision training and planning", use_depth=True)
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=None, help="training batch sizes, --batch-size by default")
+parser.add_argument('--amp-modes', type=str, nargs='+', default=['off', 'bf16'], choices=['off', 'fp16', 'bf16'], help="the --amp settings compared")
+parser.add_argument('--steps', type=int, default=5)
+parser.add_argument('--warmup', type=int, default=1)
+parser.add_argument('--setting', type=str, default='', help=argparse.SUPPRESS)
+args = parse_benchmark_args(parser)
+device = args.device
+
+
+def measure(amp, batch_size):
+    args.amp, args.batch_size = amp, batch_size
+    torch.manual_seed(0)
+    net = ConvLSTMMulti(args).to(device)
+    optimizer = torch.optim.Adam(net.parameters(), lr=args.lr, amsgrad=True)
+    scaler = torch.amp.GradScaler(device, enabled=amp == 'fp16')
+    manager = ActionSampleManager(args, generate_guide_grid(args.bin_divide))
+    exploration = PiecewiseSchedule([(0, 0.0)], outside_value=0.0)
+
+    h, w, pstep, his_len = args.frame_height, args.frame_width, args.pred_step, args.frame_history_len
+    rng = np.random.RandomState(0)
+    frame = rng.randint(0, 255, (1, 3 * his_len, h, w))
+    to = lambda array: torch.from_numpy(array).to(device)
+    target = {
+        'obs_batch': norm_image(to(rng.randint(0, 255, (batch_size, 1, 3 * his_len, h, w))).float()),
+        'act_batch': to(rng.uniform(-1, 1, (batch_size, pstep, 2)).astype(np.float16)),
+        'prev_action': to(rng.uniform(-1, 1, (batch_size, his_len - 1, 2)).astype(np.float16)),
+        'sp_batch': to(rng.uniform(0, 30, (batch_size, pstep + 1)).astype(np.float16)),
+        'depth_batch': to(rng.uniform(0, 1, (batch_size, pstep + 1, h, w)).astype(np.float16)),
+        'seg_batch': to(rng.randint(0, args.classes, (batch_size, pstep + 1, h, w))),
+    }
+    for key in ['coll', 'offroad', 'offlane']:
+        target[key + '_batch'] = to(rng.randint(0, 2, (batch_size, pstep)))
+
+    def losses(output):
+        # the loss terms and weights of Trainer.train_model, in FP32 as one_loss computes them
+        loss = nn.NLLLoss()(output['seg_pred'].view(-1, args.classes, h, w).float(), target['seg_batch'].view(-1, h, w))
+        loss += nn.L1Loss()(output['depth_pred'].view(-1, h, w).float(), target['depth_batch'].view(-1, h, w).float())
+        for key, weight in [('coll', 1.0), ('offroad', 1.0), ('offlane', 0.2)]:
+            loss += weight * nn.CrossEntropyLoss()(output[key + '_prob'].view(-1, 2).float(), target[key + '_batch'].view(-1))
+        loss += 0.01 * nn.MSELoss()(output['speed'].float(), target['sp_batch'][:, 1:].unsqueeze(dim=2).float())
+        return loss
+
+    def train_step():
+        optimizer.zero_grad()
+        with amp_autocast(args):
+            output = net(target['obs_batch'], target['act_batch'], action_var=target['prev_action'])
+        loss = losses(output)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    def plan_step():
+        obs_var = torch.from_numpy(frame).float()
+        action_var = torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, his_len - 1, 1).float()
+        manager.sample_action(net, frame, obs_var, action_var, exploration, 0, testing=True)
+
+    def timed(step, num):
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(num):
+            step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        return (time.time() - start) / max(1, num) * 1000
+
+    # planning first: its peak is below the training one, so the max RSS after both is the training peak
+    net.eval()
+    timed(plan_step, args.warmup)
+    plan_ms = timed(plan_step, args.steps)
+    net.train()
+    timed(train_step, args.warmup)
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    train_ms = timed(train_step, args.steps)
+    if device == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    return {'train_ms': train_ms, 'plan_ms': plan_ms, 'peak_mb': peak}
+
+
+if args.setting != '':
+    amp, batch_size = args.setting.split(':')
+    print(json.dumps(measure(amp, int(batch_size))))
+    sys.exit(0)
+
+for batch_size in args.batch_sizes or [args.batch_size]:
+    baseline = None
+    for amp in args.amp_modes:
+        out = subprocess.run([sys.executable] + sys.argv + ['--setting', '{}:{}'.format(amp, batch_size)], capture_output=True, text=True)
+        if out.returncode != 0:
+            # a negative return code is a signal, e.g. -9 when the process ran out of memory
+            print("{} | batch {:>3} | amp {:<4} | failed with return code {}: {}".format(device, batch_size, amp, out.returncode, (out.stderr.strip().splitlines() or [''])[-1]))
+            continue
+        stats = json.loads(out.stdout.strip().splitlines()[-1])
+        baseline = stats if baseline is None else baseline
+        print("{} | batch {:>3} | amp {:<4} | train {:.0f} ms/step ({:.2f}x) | peak {:.0f} MB ({:.2f}x) | planning {:.1f} ms/step ({:.2f}x)".format(
+            device, batch_size, amp, stats['train_ms'], baseline['train_ms'] / stats['train_ms'], stats['peak_mb'], stats['peak_mb'] / baseline['peak_mb'],
+            stats['plan_ms'], baseline['plan_ms'] / stats['plan_ms']))
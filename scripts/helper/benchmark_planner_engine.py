@@ -0,0 +1,60 @@
+# compare the planning step (ActionSampleManager.sample_action) of an untrained model in eager mode with the
+# exported planner.PlannerEngine on the CPU: control-loop rate, and the largest difference of the guidance
+# logits and candidate costs between the two
+# usage (from scripts/): python helper/benchmark_planner_engine.py --frame-size 256 --steps 20
+import sys
+import time
+import tempfile
+import numpy as np
+import torch
+
+sys.path.append("..")
+from benchmark_args import benchmark_parser, parse_benchmark_args
+from models.model import ConvLSTMMulti
+from actionsampler import ActionSampleManager
+from manager import BufferManager
+from planner import export_planner, PlannerEngine
+from utils.util import norm_image, generate_guide_grid, PiecewiseSchedule
+
+
+# the engine runs on the CPU, the eager model is compared there
+parser = benchmark_parser("benchmark the exported planner", device='cpu')
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--warmup', type=int, default=2)
+args = parse_benchmark_args(parser)
+net = ConvLSTMMulti(args).eval()
+manager = ActionSampleManager(args, generate_guide_grid(args.bin_divide))
+exploration = PiecewiseSchedule([(0, 0.0)], outside_value=0.0)
+action_var = torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, args.frame_history_len - 1, 1).float()
+
+engine_path = tempfile.mkdtemp()
+print("export | max difference to eager on new inputs {:.2e}".format(export_planner(net, manager, engine_path)))
+engine = PlannerEngine(engine_path)
+
+# the same observation and candidates through both
+obs_var = torch.randint(0, 255, (1, 3 * args.frame_history_len, args.frame_height, args.frame_width)).float()
+imgs = norm_image(obs_var).view(1, 1, 3 * args.frame_history_len, args.frame_height, args.frame_width)
+actions = torch.rand(manager.cand_num, args.pred_step, args.num_total_act) * 2 - 1
+with torch.no_grad():
+    diffs = []
+    for planner in [net, engine]:
+        history, logit = planner.encode(imgs, action_var, with_guide=True, outputs=manager.cost_outputs())
+        diffs.append([logit] + list(manager.estimate_cost(planner, history, actions)))
+print("guide logits {:.2e} | cost {:.2e} | ins cost {:.2e}".format(*[(a - b).abs().max().item() for a, b in zip(*diffs)]))
+
+
+def run(planner):
+    obs_buffer = BufferManager.ObsBuffer(args.frame_history_len)
+    feature_cache = BufferManager.FeatureCache(args.frame_history_len)
+    for i in range(args.warmup + args.steps):
+        if i == args.warmup:
+            start = time.time()
+        obs = np.random.randint(0, 255, (args.frame_height, args.frame_width, 3)).astype(np.uint8)
+        obs_var = torch.from_numpy(obs_buffer.store_frame(obs)).unsqueeze(0).float()
+        feature_cache.store_frame(i)
+        manager.sample_action(planner, obs, obs_var, action_var, exploration, 0, feature_cache=feature_cache)
+    return args.steps / (time.time() - start)
+
+
+eager_hz, engine_hz = run(net), run(engine)
+print("cpu | eager {:.2f} Hz | engine {:.2f} Hz | speedup {:.2f}x".format(eager_hz, engine_hz, engine_hz / eager_hz))
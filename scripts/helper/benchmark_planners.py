@@ -0,0 +1,57 @@
+# planning quality vs. compute of the shooting / cem / mppi planners (ActionSampleManager.planner) on an untrained model:
+# per step the rounds run, the candidates evaluated, the latency and the cost of the chosen action sequence,
+# the same random frames are planned by every planner, with and without a per-step budget
+# usage (from scripts/): python helper/benchmark_planners.py --frame-size 128 --steps 10 --budget 0 500
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.append("..")
+from benchmark_args import benchmark_parser, parse_benchmark_args
+from models.model import ConvLSTMMulti
+from actionsampler import ActionSampleManager
+from utils.util import norm_image, generate_guide_grid
+
+
+parser = benchmark_parser("benchmark the planners", sample_type='prob')
+parser.add_argument('--steps', type=int, default=10)
+parser.add_argument('--budget', type=float, nargs='+', default=[0], help="per-step budgets (ms) to compare, 0 for none")
+args = parse_benchmark_args(parser)
+device = torch.device(args.device)
+torch.manual_seed(0)
+net = ConvLSTMMulti(args).to(device).eval()
+action_var = torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, args.frame_history_len - 1, 1).float().to(device)
+rng = np.random.RandomState(0)
+frames = [rng.randint(0, 255, (1, 1, 3 * args.frame_history_len, args.frame_height, args.frame_width)) for _ in range(args.steps)]
+with torch.no_grad():
+    encoded = []
+    for frame in frames:
+        history, logit = net.encode(norm_image(torch.from_numpy(frame).float().to(device)), action_var, with_guide=True,
+                                    outputs=ActionSampleManager(args, None).cost_outputs())
+        encoded.append((history, F.softmax(logit[0] / args.temperature, dim=-1).cpu().numpy()))
+
+
+def run(planner, budget):
+    args.planner = planner
+    manager = ActionSampleManager(args, generate_guide_grid(args.bin_divide))
+    stats = dict()
+    add = lambda key, value: stats.setdefault(key, []).append(value)
+    for history, p in encoded:
+        start = time.time()
+        deadline = start + budget / 1000.0 if budget > 0 else None
+        res, rounds, evaluated = manager.planner.plan(net, history, p, manager.guides, device, deadline)
+        add('ms', (time.time() - start) * 1000)
+        add('rounds', rounds)
+        add('candidates', evaluated)
+        with torch.no_grad():
+            add('cost', manager.estimate_cost(net, history, torch.from_numpy(res).float().unsqueeze(0).to(device))[0].item())
+    return {key: np.mean(value) for key, value in stats.items()}
+
+
+for budget in args.budget:
+    for planner in ['shooting', 'cem', 'mppi']:
+        stats = run(planner, budget)
+        print("{} | budget {:>6} | {:<8} | rounds {:.1f} | candidates {:.0f} | {:.1f} ms/step | chosen cost {:.2f}".format(
+            device, '{:.0f}ms'.format(budget) if budget > 0 else 'none', planner, stats['rounds'], stats['candidates'], stats['ms'], stats['cost']))
@@ -0,0 +1,73 @@
+# FLOPs and latency of the backbone and ConvLSTM work in one planning step, with all five pyramid levels
+# (what the model ran before) vs. only the levels the enabled heads read (p3 alone when detection is off)
+# defaults follow scripts/train_carla.sh (carla8): 256x256 frames, 3 history frames, 10 predicted steps, 20 candidates (--cand-num)
+# usage (from scripts/): python helper/benchmark_pyramid_levels.py --repeat 3
+import sys
+import time
+import torch
+import torch.nn as nn
+
+sys.path.append("..")
+from models.retinanet import FPN50
+from models.convLSTM import convLSTM
+from utils import tile_single
+from benchmark_args import benchmark_parser, parse_benchmark_args
+
+
+parser = benchmark_parser("benchmark pyramid level pruning")
+parser.add_argument('--repeat', type=int, default=3)
+args = parse_benchmark_args(parser)
+device = torch.device(args.device)
+
+
+def count_macs(module, func):
+    # multiply-accumulates of all Conv2d / Linear layers called by func
+    macs = [0]
+
+    def hook(layer, inputs, output):
+        if isinstance(layer, nn.Conv2d):
+            kernel = layer.kernel_size[0] * layer.kernel_size[1] * layer.in_channels // layer.groups
+            macs[0] += output.numel() * kernel
+        else:
+            macs[0] += output.numel() * layer.in_features
+
+    handles = [layer.register_forward_hook(hook) for layer in module.modules() if isinstance(layer, (nn.Conv2d, nn.Linear))]
+    func()
+    for handle in handles:
+        handle.remove()
+    return macs[0]
+
+
+def timeit(func):
+    func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.repeat):
+        func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / args.repeat * 1000
+
+
+def measure(num_levels):
+    fpn = FPN50(num_levels).to(device).eval()
+    lstm = convLSTM(args, num_levels=num_levels).to(device).eval()
+    frame = torch.rand(1, 3, args.frame_height, args.frame_width, device=device)
+    action = torch.rand(args.cand_num, 2, device=device)
+    with torch.no_grad():
+        fms = [fm.expand(args.cand_num, *fm.shape[1:]) for fm in fpn(frame)]
+        # concatenated inputs keep the cells on the nn.Conv2d path the MAC hooks see
+        fms_seq = [[tile_single(fm, action) for fm in fms] for _ in range(args.frame_history_len)]
+        fpn_func = lambda: fpn(frame)
+        lstm_func = lambda: lstm(fms_seq)
+        # one new frame is encoded per step (feature cache), the ConvLSTM runs once per predicted step
+        macs = count_macs(fpn, fpn_func) + args.pred_step * count_macs(lstm, lstm_func)
+        latency = timeit(fpn_func) + args.pred_step * timeit(lstm_func)
+    return macs, latency
+
+
+full_macs, full_ms = measure(5)
+pruned_macs, pruned_ms = measure(1)
+print("{} | all levels {:.1f} GMACs {:.1f} ms | p3 only {:.1f} GMACs {:.1f} ms | {:.1f}% fewer MACs, {:.2f}x faster".format(
+    device, full_macs / 1e9, full_ms, pruned_macs / 1e9, pruned_ms, 100 * (1 - pruned_macs / full_macs), full_ms / pruned_ms))
@@ -0,0 +1,71 @@
+# compare the windowed ConvLSTM rollout (history window replayed from a zero state at every step) with
+# --stateful-rollout (state carried across steps) on batches sampled from a recorded SPC buffer:
+# rollout latency, and prediction quality against the recorded labels (seg pixel accuracy, event accuracy, speed error)
+# takes the usual training flags, the buffer is loaded from the save path they point to, e.g. (from scripts/):
+# python helper/compare_rollout_modes.py --env carla8 --id 200 --use-collision --use-offroad --use-offlane --use-speed \
+#     --checkpoint <window model> --stateful-checkpoint <model trained with --stateful-rollout> --batches 20
+import sys
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.append("..")
+from args import init_parser, post_processing
+from models.model import ConvLSTMMulti
+from spcbuffer import SPCBuffer
+from prefetcher import BatchPrefetcher
+
+
+parser = argparse.ArgumentParser(description="compare windowed and stateful rollouts")
+init_parser(parser)
+parser.add_argument('--stateful-checkpoint', type=str, default='', help="weights for the stateful mode, --checkpoint if empty")
+parser.add_argument('--batches', type=int, default=20)
+args = post_processing(parser.parse_args())
+device = torch.device(args.device)
+
+
+def load_net(stateful, checkpoint):
+    mode_args = copy.copy(args)
+    mode_args.stateful_rollout = stateful
+    net = ConvLSTMMulti(mode_args)
+    net.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    return net.to(device).eval()
+
+
+def evaluate(net, batches):
+    stats, latency = dict(), 0.0
+    add = lambda key, value: stats.setdefault(key, []).append(float(value))
+    for target in batches:
+        with torch.no_grad():
+            history = net.encode(target['obs_batch'], target['prev_action'])
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            output = net.rollout(history, target['act_batch'], training=False)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            latency += time.time() - start
+
+        seg_pred = output['seg_pred'][:, 1:].argmax(2)
+        add('seg_acc', (seg_pred == target['seg_batch'][:, 1:].long()).float().mean())
+        for name, key in [('coll', 'coll_prob'), ('offroad', 'offroad_prob'), ('offlane', 'offlane_prob')]:
+            if key in output:
+                add(name + '_acc', (output[key].argmax(-1) == target[name + '_batch'].long()).float().mean())
+        if 'speed' in output:
+            add('speed_l1', (output['speed'].view(-1) - target['sp_batch'][:, 1:].reshape(-1)).abs().mean())
+    return {key: np.mean(value) for key, value in stats.items()}, latency / len(batches) * 1000
+
+
+spc_buffer = SPCBuffer(args)
+spc_buffer.load(args.save_path)
+prefetcher = BatchPrefetcher(spc_buffer, args.batch_size, args.batches, num_prefetch=1, num_workers=1)
+batches = [prefetcher.next() for _ in range(args.batches)]
+prefetcher.close()
+
+for stateful in [False, True]:
+    checkpoint = args.stateful_checkpoint if stateful and args.stateful_checkpoint != '' else args.checkpoint
+    stats, latency = evaluate(load_net(stateful, checkpoint), batches)
+    print("{:<8} | rollout {:.1f} ms/batch | {}".format('stateful' if stateful else 'window', latency,
+          ' | '.join('{} {:.4f}'.format(key, value) for key, value in sorted(stats.items()))))
@@ -0,0 +1,42 @@
+# export the planning of a trained model (guidance + rollout + cost of ActionSampleManager) as TorchScript graphs
+# for CPU inference with planner.PlannerEngine, optionally also as ONNX graphs; the number of candidates, pred_step,
+# frame size and the --use-* / --sample-with-* flags are fixed in the export, e.g. (from scripts/):
+# python helper/export_planner.py --use-collision --use-offroad --use-offlane --use-speed --sample-with-collision \
+#     --sample-with-offroad --sample-with-offlane --checkpoint <model> --engine-path <output dir> --onnx
+# the exported directory is then passed to main.py --eval with --planner-engine; with --int8-backbone the backbone is
+# quantized first (see helper/quantize_backbone.py), calibrated on frames of the SPC buffer under the save path
+import sys
+import argparse
+import torch
+
+sys.path.append("..")
+from args import init_parser, post_processing
+from models.model import ConvLSTMMulti
+from actionsampler import ActionSampleManager
+from planner import export_planner
+from models.quantize import calibration_frames, quantize_backbone
+from spcbuffer import SPCBuffer
+from utils.util import generate_guide_grid
+
+
+parser = argparse.ArgumentParser(description="export the planner")
+init_parser(parser)
+parser.add_argument('--engine-path', type=str, default='planner_engine')
+parser.add_argument('--onnx', action='store_true', help="also write ONNX graphs (needs the onnx package)")
+parser.add_argument('--int8-backbone', action='store_true', help="quantize the backbone to INT8 before exporting")
+parser.add_argument('--calibration-frames', type=int, default=256)
+args = post_processing(parser.parse_args())
+# the engine runs on the CPU, trace there
+args.device = 'cpu'
+
+net = ConvLSTMMulti(args)
+net.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+net.eval()
+if args.int8_backbone:
+    spc_buffer = SPCBuffer(args)
+    spc_buffer.load(args.save_path)
+    quantize_backbone(net, calibration_frames(spc_buffer, args.calibration_frames))
+manager = ActionSampleManager(args, generate_guide_grid(args.bin_divide))
+diff = export_planner(net, manager, args.engine_path, onnx=args.onnx)
+print("exported planner to {} | {} candidates x {} steps | max difference to eager on new inputs {:.2e}".format(
+    args.engine_path, manager.cand_num, args.pred_step, diff))
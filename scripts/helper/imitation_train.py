@@ -120,10 +120,9 @@ def train(args):
     # initialize the training model
     train_net = ConvLSTMMulti(args)
     train_net.train()
-    if torch.cuda.is_available():
-        train_net = train_net.cuda()
-        if args.data_parallel:
-            train_net = torch.nn.DataParallel(train_net)
+    train_net = train_net.to(args.device)
+    if args.data_parallel and args.device == 'cuda':
+        train_net = torch.nn.DataParallel(train_net)
 
     trainset = DemonstrationDataset('Demonstrations', train=True, transform=transform, input_size=256)
     testset = DemonstrationDataset('Demonstrations', train=False, transform=transform, input_size=256)
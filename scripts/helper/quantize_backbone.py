@@ -0,0 +1,80 @@
+# post-training static INT8 quantization of the FPN50 backbone for CPU planning: calibrate on frames drawn from a
+# recorded SPC buffer, then compare the INT8 model with the FP32 one on other buffer batches: backbone latency and
+# size, and the seg mIoU / event accuracy against the recorded labels; everything runs on the CPU
+# takes the usual training flags, the buffer is loaded from the save path they point to, e.g. (from scripts/):
+# python helper/quantize_backbone.py --env carla8 --id 200 --use-collision --use-offroad --use-offlane --use-speed \
+#     --checkpoint <model> --calibration-frames 256 --batches 10
+# export an INT8 planner for CPU actors with helper/export_planner.py --int8-backbone
+import io
+import sys
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.append("..")
+from args import init_parser, post_processing
+from models.model import ConvLSTMMulti
+from models.quantize import calibration_frames, quantize_backbone
+from spcbuffer import SPCBuffer
+from utils.eval_segm import mean_IU
+from utils.util import norm_image
+
+
+parser = argparse.ArgumentParser(description="quantize the backbone to INT8")
+init_parser(parser)
+parser.add_argument('--calibration-frames', type=int, default=256)
+parser.add_argument('--batches', type=int, default=10)
+parser.add_argument('--quantize-heads', action='store_true', help="also quantize the Linear layers of the guidance and speed heads dynamically")
+parser.add_argument('--backend', type=str, default='x86')
+args = post_processing(parser.parse_args())
+
+fp32_net = ConvLSTMMulti(args)
+fp32_net.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+fp32_net.eval()
+spc_buffer = SPCBuffer(args)
+spc_buffer.load(args.save_path)
+int8_net = quantize_backbone(copy.deepcopy(fp32_net), calibration_frames(spc_buffer, args.calibration_frames),
+                             backend=args.backend, with_heads=args.quantize_heads)
+
+batches = []
+for _ in range(args.batches):
+    target = {key: torch.from_numpy(np.array(value)).float() for key, value in spc_buffer.sample(args.batch_size).items() if key != 'original_bboxes'}
+    target['obs_batch'] = norm_image(target['obs_batch'])
+    batches.append(target)
+
+
+def evaluate(net):
+    stats = dict()
+    add = lambda key, value: stats.setdefault(key, []).append(float(value))
+    for target in batches:
+        with torch.no_grad():
+            output = net(target['obs_batch'], target['act_batch'], action_var=target['prev_action'], training=False)
+        seg_pred = output['seg_pred'].argmax(2).numpy()
+        seg_target = target['seg_batch'].long().numpy()
+        add('seg_miou', np.mean([mean_IU(pred, gt) for pred, gt in zip(seg_pred.reshape(-1, *seg_pred.shape[-2:]), seg_target.reshape(-1, *seg_target.shape[-2:]))]))
+        for name, key in [('coll', 'coll_prob'), ('offroad', 'offroad_prob'), ('offlane', 'offlane_prob')]:
+            if key in output:
+                add(name + '_acc', (output[key].argmax(-1) == target[name + '_batch'].long()).float().mean())
+    return {key: np.mean(value) for key, value in stats.items()}
+
+
+def backbone_cost(net, repeat=10):
+    frame = batches[0]['obs_batch'][:1, 0, -3:]
+    with torch.no_grad():
+        net.conv_lstm.fpn(frame)
+        start = time.time()
+        for _ in range(repeat):
+            net.conv_lstm.fpn(frame)
+    buffer = io.BytesIO()
+    torch.save(net.conv_lstm.fpn.state_dict(), buffer)
+    return (time.time() - start) / repeat * 1000, buffer.tell() / 2**20
+
+
+results = dict()
+for name, net in [('fp32', fp32_net), ('int8', int8_net)]:
+    latency, size = backbone_cost(net)
+    results[name] = dict(evaluate(net), backbone_ms=latency, backbone_mb=size)
+    print("{} | {}".format(name, ' | '.join('{} {:.4f}'.format(key, value) for key, value in sorted(results[name].items()))))
+print("delta | {}".format(' | '.join('{} {:+.4f}'.format(key, results['int8'][key] - results['fp32'][key]) for key in sorted(results['fp32']))))
@@ -107,7 +107,7 @@ def main(dataset_type):
 
     dataloader = DataLoader(dataset=dataset, batch_size=1, shuffle=False)
 
-    model = ConvLSTMMulti(args).cuda()
+    model = ConvLSTMMulti(args).to(args.device)
     model.eval()
     state_dict = torch.load("/home/jinkun/git/spc_trained.pt")
     model.load_state_dict(state_dict)
@@ -124,17 +124,17 @@ def main(dataset_type):
     for index, data in enumerate(dataloader):
         imgs, imgs_ori = data
         # imgs: sized [batch_size, frame, h, w, 3]
-        imgs = torch.transpose(imgs, 2, 4).transpose(3, 4).cuda()
+        imgs = torch.transpose(imgs, 2, 4).transpose(3, 4).to(args.device)
         imgs_ori = torch.transpose(imgs_ori, 2, 4).transpose(3, 4)
-        obs_var = imgs.reshape(1, 9, 256, 256).cuda()
+        obs_var = imgs.reshape(1, 9, 256, 256).to(args.device)
         obs = imgs[0, -1].transpose(0, 2).transpose(0, 1).cpu().numpy()
         obs_ori = imgs_ori[0, -1].transpose(0, 2).transpose(0, 1).numpy()
-        action_var = torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, args.frame_history_len - 1, 1).float().cuda()
+        action_var = torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, args.frame_history_len - 1, 1).float().to(args.device)
         action, guidance_action, p = actionsampler.sample_action(net=model, obs=obs, obs_var=obs_var, action_var=action_var, exploration=exploration, step=0, testing=True)
         throttle = action[0] * 0.5 + 0.5
         steer = action[1] * 0.4
         obs_var = norm_image(obs_var).unsqueeze(0)
-        action = torch.Tensor(action).cuda().unsqueeze(0)
+        action = torch.Tensor(action).to(args.device).unsqueeze(0)
         output = model(obs_var, action, training=False, action_var=action_var)
 
         action = action[0][0]
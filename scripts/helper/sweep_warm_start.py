@@ -0,0 +1,76 @@
+# planning cost vs. number of candidates with and without the --warm-start receding-horizon seed: replays
+# consecutive frames of a recorded SPC buffer through ActionSampleManager.sample_action (history actions as
+# recorded) and re-evaluates the chosen action sequence of every step with the model; lower is better
+# driving reward needs the simulator: evaluate with the --cand-num / --warm-start settings picked here
+# takes the usual training flags, the buffer is loaded from the save path they point to, e.g. (from scripts/):
+# python helper/sweep_warm_start.py --env carla8 --id 200 --use-collision --use-offroad --use-offlane --use-speed \
+#     --sample-with-collision --sample-with-offroad --sample-with-offlane --checkpoint <model> --cand-nums 6 10 20
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.append("..")
+from args import init_parser, post_processing
+from models.model import ConvLSTMMulti
+from actionsampler import ActionSampleManager
+from manager import BufferManager
+from spcbuffer import SPCBuffer
+from utils import generate_guide_grid, PiecewiseSchedule, norm_image
+
+
+parser = argparse.ArgumentParser(description="sweep the candidate count with and without warm start")
+init_parser(parser)
+parser.add_argument('--cand-nums', type=int, nargs='+', default=[6, 8, 10, 15, 20])
+parser.add_argument('--steps', type=int, default=50, help="consecutive recorded frames replayed per setting")
+args = post_processing(parser.parse_args())
+
+net = ConvLSTMMulti(args)
+net.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+net = net.to(args.device).eval()
+spc_buffer = SPCBuffer(args)
+spc_buffer.load(args.save_path)
+
+# the first run of steps frames without an episode end
+done = spc_buffer.done[:spc_buffer.num_in_buffer] != 0
+start = next(i for i in range(len(done) - args.steps) if not done[i: i + args.steps].any())
+exploration = PiecewiseSchedule([(0, 0.0)], outside_value=0.0)
+
+
+def net_input(obs_var):
+    imgs = norm_image(obs_var.to(args.device))
+    return imgs.view(1, 1, *imgs.size()[-3:])
+
+
+def replay(cand_num, warm_start):
+    args.cand_num, args.warm_start = cand_num, warm_start
+    manager = ActionSampleManager(args, generate_guide_grid(args.bin_divide))
+    obs_buffer = BufferManager.ObsBuffer(args.frame_history_len)
+    action_buffer = BufferManager.ActionBuffer(args.frame_history_len - 1)
+    feature_cache = BufferManager.FeatureCache(args.frame_history_len)
+    action_var = torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, args.frame_history_len - 1, 1).float()
+    costs, latency = [], 0.0
+    for idx in range(start, start + args.steps):
+        obs = spc_buffer.obs[idx].transpose(1, 2, 0)
+        obs_var = torch.from_numpy(obs_buffer.store_frame(obs)).unsqueeze(0).float()
+        feature_cache.store_frame(idx)
+        step_start = time.time()
+        action, _, _ = manager.sample_action(net, obs, obs_var, action_var, exploration, 0, testing=True, feature_cache=feature_cache)
+        latency += time.time() - step_start
+        with torch.no_grad():
+            history = net.encode(net_input(obs_var), action_var.to(args.device), feature_cache=feature_cache, outputs=manager.cost_outputs())
+            cost, _ = manager.estimate_cost(net, history, torch.from_numpy(action).float().unsqueeze(0).to(args.device))
+        costs.append(cost.item())
+        # the recorded action was executed, as in the buffer
+        action_var = torch.from_numpy(action_buffer.store_frame(spc_buffer.action[idx].astype(np.float64))).float()
+    return np.mean(costs), latency / args.steps * 1000
+
+
+baseline = None
+for cand_num in sorted(args.cand_nums, reverse=True):
+    for warm_start in [False, True]:
+        cost, ms = replay(cand_num, warm_start)
+        baseline = cost if baseline is None else baseline
+        print("{} | candidates {:>3} | warm start {:<5} | cost {:.3f} ({:+.3f} vs. {} cold) | {:.1f} ms/step".format(
+            args.device, cand_num, str(warm_start), cost, cost - baseline, max(args.cand_nums), ms))
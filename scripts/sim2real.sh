@@ -41,7 +41,7 @@
 	# --resume \
 	# --use-offlane \
 	# --use-detection \
-	# --CEM \
+	# --planner cem \
     	# --use-detection \
 	#e--detach-seg
 	# --use-orientation \
@@ -43,7 +43,7 @@ cd ..
 	# --resume \
 	# --use-offlane \
 	# --use-detection \
-	# --CEM \
+	# --planner cem \
     	# --use-detection \
 	#e--detach-seg
 	# --use-orientation \
@@ -1,7 +1,6 @@
 from __future__ import division, print_function
 import numpy as np
 import os
-import random
 import torch
 from torch.autograd import Variable
 from utils.dataset import DataEncoder
@@ -33,7 +32,13 @@ class SPCBuffer(object):
         self.bboxes_cls = None
         self.expert = None
         self.guide_action = None
+        # valid_start[i] is set iff a sample starting at frame i has its full history/future window stored and no episode end inside
+        self.valid_start = None
+        # np.flatnonzero(valid_start), kept until valid_start changes so that sampling stays O(batch)
+        self._valid_indices = None
+        self.rng = np.random.default_rng(np.random.randint(2**31 - 1))
         self.epi_lens = []
+        self._batch_buffers = dict()
         self.bbox_encoder = DataEncoder()
         width, height = self.args.frame_width, self.args.frame_height
         anchors = self.bbox_encoder._get_anchor_boxes(input_size=torch.Tensor((width, height)))
@@ -64,82 +69,185 @@ class SPCBuffer(object):
         obs = torch.from_numpy(np.concatenate([self.obs[idx][np.newaxis, :] for idx in indices], axis=0)).float()
         obs = norm_image(obs)
         guide_action = Variable(torch.from_numpy(self.guide_action[indices]), requires_grad=False).long()
-        if torch.cuda.is_available():
-            obs = obs.cuda()
-            guide_action = guide_action.cuda()
-        return obs, guide_action
-
-    def sample_n_unique(self, sampling_f, n):
-        res = []
-        while len(res) < n:
-            candidate = sampling_f()
-            done = self.sample_done(candidate)
-            if candidate not in res and done:
-                res.append(candidate)  
-        return res
-
-    def sample_done(self, idx):
-        if idx < 10 or idx >= self.num_in_buffer - self.args.pred_step - 10:
-            return False
-        else:
-            done_list = self.done[idx - self.args.frame_history_len + 1: idx + self.args.pred_step + 1]
-            if np.sum(done_list) >= 1.0:
-                return False
-            else:
-                return True
+        return obs.to(self.args.device), guide_action.to(self.args.device)
+
+    def _array_layout(self):
+        # (name, shape, dtype) of every fixed-size array in the buffer, which is also the on-disk layout in mmap mode
+        size, h, w = self.args.buffer_size, self.args.frame_height, self.args.frame_width
+        return [
+            ('obs', [size, 3, h, w], np.uint8),
+            ('action', [size, self.args.num_total_act], np.float16),
+            ('done', [size], np.int8),
+            ('expert', [size], np.float16),
+            ('guide_action', [size], np.int8),
+            ('collision', [size], np.int8),
+            ('collision_other', [size], np.int8),
+            ('collision_vehicles', [size], np.int8),
+            ('offroad', [size], np.int8),
+            ('offlane', [size], np.int8),
+            ('speed', [size], np.float16),
+            ('seg', [size, h, w], np.uint8),
+            ('depth', [size, h, w], np.float16),
+            ('valid_start', [size], bool),
+        ]
+
+    def _spc_path(self):
+        return os.path.join(self.args.save_path, 'spc_checkpoint')
+
+    def _allocate(self):
+        # allocate every array of _array_layout; in mmap mode each array lives in its own raw file under the
+        # checkpoint folder, so a checkpoint is just a flush and resuming maps the files back
+        if not self.args.buffer_mmap:
+            for name, shape, dtype in self._array_layout():
+                self.__dict__[name] = np.empty(shape, dtype=dtype)
+            return
+        mmap_path = os.path.join(self._spc_path(), 'mmap')
+        if not os.path.isdir(mmap_path):
+            os.makedirs(mmap_path)
+        layout = dict()
+        for name, shape, dtype in self._array_layout():
+            self.__dict__[name] = np.memmap(os.path.join(mmap_path, '{}.dat'.format(name)), dtype=dtype, mode='w+', shape=tuple(shape))
+            layout[name] = {'shape': list(shape), 'dtype': np.dtype(dtype).str}
+        # written once all files exist and replaced atomically, so _map_arrays never reads a partial layout
+        layout_file = os.path.join(mmap_path, 'layout.json')
+        with open(layout_file + '.tmp', 'w') as f:
+            json.dump(layout, f)
+        os.replace(layout_file + '.tmp', layout_file)
+
+    def _map_arrays(self):
+        # map the raw files of an mmap-mode checkpoint instead of loading them into memory,
+        # they are only copied into RAM when resuming without --buffer-mmap
+        mmap_path = os.path.join(self._spc_path(), 'mmap')
+        layout_file = os.path.join(mmap_path, 'layout.json')
+        if not os.path.exists(layout_file):
+            return
+        layout = json.load(open(layout_file, 'r'))
+        for name in layout:
+            array = np.memmap(os.path.join(mmap_path, '{}.dat'.format(name)),
+                              dtype=np.dtype(layout[name]['dtype']), mode='r+', shape=tuple(layout[name]['shape']))
+            self.__dict__[name] = array if self.args.buffer_mmap else np.array(array)
+
+    def _window_len(self):
+        # number of consecutive frames a training sample spans: history frames + future frames
+        return self.args.frame_history_len + self.args.pred_step
+
+    def _invalidate_starts(self, idx):
+        # frame $idx is about to be overwritten, so no sample window may cover it any more
+        offsets = np.arange(-self.args.pred_step, self.args.frame_history_len)
+        self.valid_start[(idx + offsets) % self.args.buffer_size] = False
+        self._valid_indices = None
+
+    def _update_valid_start(self, idx):
+        # frame $idx just got its done flag, which completes the window of the sample starting pred_step frames earlier
+        if self.num_in_buffer < self._window_len():
+            return
+        start = idx - self.args.pred_step
+        window = (start + np.arange(-self.args.frame_history_len + 1, self.args.pred_step + 1)) % self.args.buffer_size
+        self.valid_start[start % self.args.buffer_size] = not self.done[window].any()
+        self._valid_indices = None
+
+    def _rebuild_valid_start(self):
+        # recompute the whole valid-start index from the done flags, e.g. for checkpoints saved without it
+        size, win = self.args.buffer_size, self._window_len()
+        self.valid_start = np.zeros([size], dtype=bool)
+        self._valid_indices = None
+        if self.num_in_buffer < win:
+            return
+        # frames in chronological order, oldest first
+        order = (self.next_idx - self.num_in_buffer + np.arange(self.num_in_buffer)) % size
+        done_cum = np.concatenate([[0], np.cumsum(self.done[order] != 0)])
+        ends = np.arange(win, self.num_in_buffer + 1)
+        clean = (done_cum[ends] - done_cum[ends - win]) == 0
+        starts = order[ends - 1 - self.args.pred_step]
+        self.valid_start[starts[clean]] = True
+
+    def _valid_starts(self):
+        if self._valid_indices is None:
+            self._valid_indices = np.flatnonzero(self.valid_start)
+        return self._valid_indices
+
+    def _sample_indices(self, batch_size):
+        return self.rng.choice(self._valid_starts(), batch_size, replace=False)
 
     def can_sample(self, batch_size):
-        return (batch_size * (self.args.pred_step + 1) + 20 + self.args.pred_step <= self.num_in_buffer)
+        return (batch_size * (self.args.pred_step + 1) + 20 + self.args.pred_step <= self.num_in_buffer) \
+            and self.valid_start is not None and len(self._valid_starts()) >= batch_size
 
     def update_epi(self, idx_buffer, safe_buffer, epi_len):
         self.expert[idx_buffer] = safe_buffer
         self.epi_lens.append(epi_len)
 
-    def _encode_sample(self, indices):
+    def _batch_buffer(self, slot, key, shape, dtype):
+        # preallocated output arrays reused across batches, pinned when batches go to the GPU for faster H2D copies
+        # batches assembled concurrently (e.g. by the prefetcher) use different slots
+        shape = tuple(shape)
+        key = (slot, key)
+        buf = self._batch_buffers.get(key)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            if self.args.device == 'cuda':
+                buf = torch.from_numpy(buf).pin_memory().numpy()
+            self._batch_buffers[key] = buf
+        return buf
+
+    def _gather(self, slot, key, source, idx, trailing_shape=None):
+        # fancy-index `source` along the first axis with an index matrix in one shot
+        shape = idx.shape + source.shape[1:]
+        buf = self._batch_buffer(slot, key, shape if trailing_shape is None else trailing_shape, source.dtype)
+        np.take(source, idx, axis=0, out=buf.reshape(shape), mode='clip')
+        return buf
+
+    def _encode_sample(self, indices, slot=0):
+        # NOTE: the returned arrays are reused by the next call with the same slot, consume (or copy) them before sampling again
         data_dict = dict()
+        batch_size = len(indices)
+        pred_step, his_len = self.args.pred_step, self.args.frame_history_len
+
+        # [batch, his_len - 1 + pred_step + 1] index matrix into the ring buffer, covering history and future frames
+        offsets = np.arange(-his_len + 1, pred_step + 1)
+        idx = (np.asarray(indices).reshape(-1, 1) + offsets) % self.args.buffer_size
+        his_idx, fut_idx = idx[:, :his_len], idx[:, his_len - 1:]
 
-        data_dict['obs_batch'] = np.concatenate([np.concatenate([self._encode_observation(idx + ii)[np.newaxis, :] for ii in range(1)], 0)[np.newaxis, :] for idx in indices], axis=0)
-        data_dict['act_batch'] = np.concatenate([self.action[idx: idx+self.args.pred_step, :][np.newaxis, :] for idx in indices], axis=0)
-        data_dict['sp_batch'] = np.concatenate([self.speed[idx: idx+self.args.pred_step+1][np.newaxis, :] for idx in indices], axis=0)
-        data_dict['prev_action'] = np.concatenate([self.action[idx-self.args.frame_history_len + 1: idx, :][np.newaxis, :] for idx in indices], axis=0)
-        data_dict['seg_batch'] = np.concatenate([self.seg[idx: idx+self.args.pred_step+1, :][np.newaxis, :] for idx in indices], axis=0)
+        obs_shape = (batch_size, 1, 3 * his_len, self.args.frame_height, self.args.frame_width)
+        data_dict['obs_batch'] = self._gather(slot, 'obs_batch', self.obs, his_idx, obs_shape)
+        data_dict['act_batch'] = self._gather(slot, 'act_batch', self.action, fut_idx[:, :-1])
+        data_dict['sp_batch'] = self._gather(slot, 'sp_batch', self.speed, fut_idx)
+        data_dict['prev_action'] = self._gather(slot, 'prev_action', self.action, his_idx[:, :-1])
+        data_dict['seg_batch'] = self._gather(slot, 'seg_batch', self.seg, fut_idx)
 
         if self.args.use_collision:
-            data_dict['coll_batch'] = np.concatenate([self.collision[idx+1: idx + self.args.pred_step + 1][np.newaxis, :] for idx in indices], axis=0)
-            data_dict['coll_other_batch'] = np.concatenate([self.collision_other[idx+1: idx + self.args.pred_step + 1][np.newaxis, :] for idx in indices], axis=0)
-            data_dict['coll_vehicles_batch'] = np.concatenate([self.collision_vehicles[idx+1: idx + self.args.pred_step + 1][np.newaxis, :] for idx in indices], axis=0)
+            data_dict['coll_batch'] = self._gather(slot, 'coll_batch', self.collision, fut_idx[:, 1:])
+            data_dict['coll_other_batch'] = self._gather(slot, 'coll_other_batch', self.collision_other, fut_idx[:, 1:])
+            data_dict['coll_vehicles_batch'] = self._gather(slot, 'coll_vehicles_batch', self.collision_vehicles, fut_idx[:, 1:])
         if self.args.use_offroad:
-            data_dict['offroad_batch'] = np.concatenate([self.offroad[idx+1: idx + self.args.pred_step + 1][np.newaxis, :] for idx in indices], axis=0)
+            data_dict['offroad_batch'] = self._gather(slot, 'offroad_batch', self.offroad, fut_idx[:, 1:])
         if self.args.use_offlane:
-            data_dict['offlane_batch'] = np.concatenate([self.offlane[idx+1: idx + self.args.pred_step + 1][np.newaxis, :] for idx in indices], axis=0)
+            data_dict['offlane_batch'] = self._gather(slot, 'offlane_batch', self.offlane, fut_idx[:, 1:])
 
         if self.args.use_depth:
-            data_dict["depth_batch"] = np.concatenate([self.depth[idx: idx+self.args.pred_step+1, :][np.newaxis, :] for idx in indices], axis=0)
+            data_dict["depth_batch"] = self._gather(slot, 'depth_batch', self.depth, fut_idx)
 
         if self.args.use_detection:
-            bboxes_batch = np.zeros([len(indices), self.args.pred_step+1, self.anchor_num, 4], dtype=np.float16)
-            cls_batch = np.zeros([len(indices), self.args.pred_step+1, self.anchor_num], dtype=np.int8)
-            colls_with_batch = np.zeros([len(indices), self.args.pred_step+1, self.anchor_num], dtype=np.int8)
-            # coll_with_batch = np.zeros([len(indices), self.args.pred_step+1, self.anchor_num], dtype=np.int8)
-            original_bboxes_batch = []
-            for i in range(len(indices)):
-                original_bboxes = []
-                idx = indices[i]
-                for j in range(self.args.pred_step + 1):
-                    bboxes = np.array(self.bboxes[idx + j])
-                    labels = np.array(self.bboxes_cls[idx + j])
-                    colls_with = np.array(self.colls_with[idx + j])
-                    bboxes_orientations = np.array([self.bboxes[idx + j][u] for u in range(len(self.bboxes[idx + j]))])
-                    original_bboxes.append(bboxes_orientations)
-                    if bboxes.shape[0] == 0:
-                        bboxes_batch[i, j, :, :4] = 0
-                        cls_batch[i, j, :] = -1
-                        colls_with_batch[i, j, :] = -1
-                    else:
-                        bboxes = torch.Tensor(bboxes)
-                        labels = torch.Tensor(labels)
-                        bboxes_batch[i, j, :, :4], cls_batch[i, j, :], colls_with_batch[i, j, :] = self.bbox_encoder.encode(bboxes, labels, colls_with, input_size=(self.args.frame_width, self.args.frame_height))
-                original_bboxes_batch.append(original_bboxes)
+            # gather the variable-length GT boxes into padded arrays and encode all frames in one pass
+            original_bboxes_batch = [[np.array(self.bboxes[frame_idx]) for frame_idx in fut_idx[i]] for i in range(batch_size)]
+            num_boxes = np.array([[len(self.bboxes[frame_idx]) for frame_idx in fut_idx[i]] for i in range(batch_size)], dtype=np.int64)
+            max_obj = int(num_boxes.max())
+            boxes = np.zeros([batch_size, pred_step+1, max_obj, 4], dtype=np.float32)
+            labels = np.zeros([batch_size, pred_step+1, max_obj], dtype=np.float32)
+            colls_with = np.zeros([batch_size, pred_step+1, max_obj], dtype=np.float32)
+            for i in range(batch_size):
+                for j in range(pred_step + 1):
+                    num, frame_idx = num_boxes[i, j], fut_idx[i, j]
+                    if num > 0:
+                        boxes[i, j, :num] = np.array(self.bboxes[frame_idx])[:, :4]
+                        labels[i, j, :num] = self.bboxes_cls[frame_idx]
+                        colls_with[i, j, :num] = self.colls_with[frame_idx]
+            loc_targets, cls_targets, colls_targets = self.bbox_encoder.encode_many(
+                torch.from_numpy(boxes), torch.from_numpy(labels), torch.from_numpy(colls_with), torch.from_numpy(num_boxes),
+                input_size=(self.args.frame_width, self.args.frame_height))
+            bboxes_batch = loc_targets.numpy().astype(np.float16)
+            cls_batch = cls_targets.numpy().astype(np.int8)
+            colls_with_batch = colls_targets.numpy().astype(np.int8)
             data_dict['bboxes_batch'] = bboxes_batch
             data_dict['cls_batch'] = cls_batch
             data_dict['colls_with_batch'] = colls_with_batch
@@ -153,10 +261,10 @@ class SPCBuffer(object):
     def decode_one(self, loc_preds, cls_preds, inputsize):
         return self.bbox_encoder.decode_one(loc_preds, cls_preds, inputsize)
 
-    def sample(self, batch_size):
+    def sample(self, batch_size, slot=0):
         assert self.can_sample(batch_size)
-        indices = self.sample_n_unique(lambda: random.randint(10, self.num_in_buffer - 10), batch_size) 
-        return self._encode_sample(indices)
+        indices = self._sample_indices(batch_size)
+        return self._encode_sample(indices, slot)
 
     def _encode_observation(self, idx):
         start_idx = idx - self.args.frame_history_len + 1
@@ -170,19 +278,8 @@ class SPCBuffer(object):
         frame = obs.transpose(2, 0, 1)  # reshape as [C, H, W]
 
         if self.obs is None:
-            self.obs = np.empty([self.args.buffer_size, 3, self.args.frame_height, self.args.frame_width], dtype=np.uint8)
-            self.action = np.empty([self.args.buffer_size, self.args.num_total_act], dtype=np.float16)
-            self.done = np.empty([self.args.buffer_size], dtype=np.int8)
-            self.expert = np.empty([self.args.buffer_size], dtype=np.float16)
-            self.guide_action = np.empty([self.args.buffer_size], dtype=np.int8)
-            self.collision = np.empty([self.args.buffer_size], dtype=np.int8)
-            self.collision_other = np.empty([self.args.buffer_size], dtype=np.int8)
-            self.collision_vehicles = np.empty([self.args.buffer_size], dtype=np.int8)
-            self.offroad = np.empty([   self.args.buffer_size], dtype=np.int8)
-            self.offlane = np.empty([self.args.buffer_size], dtype=np.int8)
-            self.speed = np.empty([self.args.buffer_size], dtype=np.float16)
-            self.seg = np.empty([self.args.buffer_size, self.args.frame_height, self.args.frame_width], dtype=np.uint8)
-            self.depth = np.empty([self.args.buffer_size, self.args.frame_height, self.args.frame_width], dtype=np.float16)
+            self._allocate()
+            self.valid_start[:] = False
 
             # because the ground truth bboxes number varies in different frames, we can't allocate a numpyarray to hold them
             self.bboxes = [[] for i in range(self.args.buffer_size)]
@@ -190,6 +287,7 @@ class SPCBuffer(object):
             self.bboxes_cls = [[] for i in range(self.args.buffer_size)]
             self.colls_with = [[] for i in range(self.args.buffer_size)]
 
+        self._invalidate_starts(self.next_idx)
         self.obs[self.next_idx] = frame
         self.collision[self.next_idx] = int(collision)
         self.collision_other[self.next_idx] = int(collision_other)
@@ -218,6 +316,7 @@ class SPCBuffer(object):
         self.guide_action[self.last_idx] = guide_action
         self.action[self.last_idx, :] = action
         self.done[self.last_idx] = int(done)
+        self._update_valid_start(self.last_idx)
 
     '''
     # this function is replaced by the two buffer classes in manager.py
@@ -248,9 +347,10 @@ class SPCBuffer(object):
         if self.args.eval:
             print('not load spc buffers in eval mode...')
             return
-        spc_path = os.path.join(self.args.save_path, 'spc_checkpoint')
+        spc_path = self._spc_path()
         if os.path.exists(spc_path):
             print('load the spcbuffer checkpoint ...')
+            self._map_arrays()
             file_list = os.listdir(spc_path)
             for filename in file_list:
                 if filename[-4:] == '.npy':
@@ -262,17 +362,26 @@ class SPCBuffer(object):
                     var_dict = json.load(open(filepath, 'r'))
                     for key in var_dict:
                         self.__dict__[key] = var_dict[key]
+            self._valid_indices = None
+            if self.valid_start is None and self.done is not None:
+                self._rebuild_valid_start()
             print("successfully load the spcbuffer checkpoint")
 
     def save(self, path):
         # In case the whole class is too large to save, we independently save different components
-        spc_path = os.path.join(self.args.save_path, 'spc_checkpoint')
+        # in mmap mode the fixed-size arrays are only flushed, leaving the small components to be written
+        spc_path = self._spc_path()
         if not os.path.isdir(spc_path):
             os.makedirs(spc_path)
         save_dict = {} 
         for key in self.__dict__.keys():
             component = self.__dict__[key]
-            if type(component) == np.ndarray:
+            if key.startswith('_'):
+                # caches (batch buffers, valid start indices) are rebuilt after loading
+                continue
+            if isinstance(component, np.memmap):
+                component.flush()
+            elif type(component) == np.ndarray:
                 np.save(os.path.join(spc_path, '{}.npy'.format(key)), component)
             elif key == "bboxes":
                 bboxes = np.array(component)
@@ -1,8 +1,9 @@
 from __future__ import division, print_function
 from manager import BufferManager
 from actionsampler import ActionSampleManager
-from utils import generate_guide_grid, color_text, log_seg, get_accuracy, visualize, visualize_guide_action, norm_image
-from models import init_models, FocalLoss
+from prefetcher import BatchPrefetcher
+from utils import generate_guide_grid, color_text, log_seg, get_accuracy, visualize, visualize_guide_action, norm_image, amp_autocast
+from models import init_models, unwrap_model, FocalLoss
 import os
 import numpy as np
 import torch
@@ -40,12 +41,13 @@ def ins_loss(step, target, output, detect_loss_func, coll_with_loss_func, logger
     target_coll_with = target['colls_with_batch']
     pred_cls = output['cls_pred']
     pred_loc = output['loc_pred']
-    pred_coll_with = output['colls_with_prob']
 
     loss = 0.0
     if not use_coll_with:
         loss = detect_loss_func(pred_loc, target_loc, pred_cls, target_cls)
     else:
+        # the model only runs coll_head with use_colls_with
+        pred_coll_with = output['colls_with_prob']
         loss = detect_loss_func(pred_loc, target_loc, pred_cls, target_cls, with_coll=True, pred_colls_with=pred_coll_with, target_colls_with=target_coll_with)
 
     print("bbox loss: {}".format(loss.data.cpu().numpy()))
@@ -53,7 +55,10 @@ def ins_loss(step, target, output, detect_loss_func, coll_with_loss_func, logger
 
 
 def one_loss(step, target, output, loss_func, field, logger):
-    loss = loss_func()(output, target)
+    # losses are computed in FP32: the predictions may be half precision under --amp, float targets float16 replay data
+    if target.is_floating_point():
+        target = target.float()
+    loss = loss_func()(output.float(), target)
     logger.write(step, "{}_loss".format(field), loss.item())
     print("{} loss: {}".format(field, loss.data.cpu().numpy()))
     return loss
@@ -77,11 +82,24 @@ def event_losses(step, targets, outputs, acc_func, loss_func, weight_dict, logge
     return loss
 
 
-def encode_target(target):
+def distill_losses(step, outputs, loss_func, logger):
+    # with --lowres-events the low-resolution event heads are trained to reproduce the outputs of the full-resolution ones
+    loss = 0.0
+    for key in outputs.keys():
+        if key.endswith('_low'):
+            loss += one_loss(step, outputs[key[:-len('_low')]].detach(), outputs[key], loss_func, key, logger)
+    return loss
+
+
+def encode_target(target, device):
     for key in target.keys():
         if key == 'original_bboxes':
             continue
-        target[key] = torch.from_numpy(target[key]).float().cuda()
+        target[key] = torch.from_numpy(target[key])
+        # float16 replay data (actions, speeds, depths) is copied as it is, the model and the losses cast it on the device
+        if target[key].dtype != torch.float16:
+            target[key] = target[key].float()
+        target[key] = target[key].to(device)
         if key == 'obs_batch':
             # shape: Batch x Pred_step x (3xHistory_len) x H x W
             target[key] = norm_image(target[key])
@@ -142,11 +160,15 @@ class Trainer():
         self.depth_loss_func = nn.L1Loss()
         self.detect_loss_func = FocalLoss()
         self.coll_with_loss_func = nn.CrossEntropyLoss
+        self.distill_loss_func = nn.MSELoss
+        # --amp fp16 scales the loss so that small gradients survive the half precision backward pass
+        self.scaler = torch.amp.GradScaler(args.device, enabled=args.amp == 'fp16')
 
         # figure out predictive task list
         self.eventloss_weights = dict() # filed -> loss weight
         self.speedloss_weight = 0.01
         self.segloss_weight = 1.0
+        self.distillloss_weight = 1.0
         # if self.args.use_detection: self.eventloss_weights['detection'] = 1.0
         # if self.args.use_colls_with: self.eventloss_weights['colls_with'] = 1.0
         if self.args.use_collision: self.eventloss_weights['coll'] = 1.0
@@ -168,9 +190,10 @@ class Trainer():
         
         # print("action [{0:.2f}, {1:.2f}] coll {2} offroad {3} offlane {4} speed {5:.2f} reward {6:.2f} explore {7:.2f}".format(action[0], action[1], info['collision'], info['offroad'],info['offlane'], info['speed'], reward, self.exploration.value(step)))
 
-    def train_model(self, args, step):
-        target = self.bmanager.spc_buffer.sample(self.bsize)
-        target = encode_target(target)
+    def train_model(self, args, step, target=None):
+        if target is None:
+            target = self.bmanager.spc_buffer.sample(self.bsize)
+            target = encode_target(target, args.device)
         target['seg_batch'] = target['seg_batch'].long()
 
         output = self.model(target['obs_batch'], target['act_batch'], action_var=target['prev_action'])
@@ -180,8 +203,8 @@ class Trainer():
         threshold = batch_thr * self.pstep
 
         if self.args.use_depth:
-            depth_pred = output["depth_pred"].view(-1, self.img_h, self.img_w)
-            depth_target = target["depth_batch"].view(-1, self.img_h, self.img_w)
+            depth_pred = output["depth_pred"].view(-1, self.img_h, self.img_w).float()
+            depth_target = target["depth_batch"].view(-1, self.img_h, self.img_w).float()
             depth_loss = self.depth_loss_func(depth_pred, depth_target)
             loss += depth_loss
             print("depth loss: {}".format(depth_loss.data.cpu().numpy()))
@@ -229,13 +252,17 @@ class Trainer():
         segloss = one_loss(step, seg_target, seg_pred, self.seg_loss_func, "seg", self.logger)
         loss += self.segloss_weight * segloss
 
+        # Loss Part #4: distillation of the low-resolution event heads used for planning
+        if args.lowres_events:
+            loss += self.distillloss_weight * distill_losses(step, output, self.distill_loss_func, self.logger)
+
         self.logger.write(step, "total_loss", loss.item())
         gc.collect()
         return loss
 
     def save(self, step):
         print(color_text('Saving models ...', 'green'))
-        torch.save(self.model.module.state_dict(),
+        torch.save(unwrap_model(self.model).state_dict(),
                         os.path.join(self.args.save_path, 'model', 'pred_model_%09d.pt' % step))
         torch.save(self.optim.state_dict(),
                     os.path.join(self.args.save_path, 'optimizer', 'optimizer.pt'))
@@ -248,7 +275,7 @@ class Trainer():
         if self.bmanager.spc_buffer.can_sample_guide(self.bsize):
             obs, guide_action = self.bmanager.spc_buffer.sample_guide(self.bsize)
             q = self.model(obs, action_only=True)
-            loss = self.guide_loss_func()(q, guide_action)
+            loss = self.guide_loss_func()(q.float(), guide_action)
             print('Guidance loss  %0.4f' % loss.data.cpu().numpy())
             return loss
         else:
@@ -258,18 +285,29 @@ class Trainer():
     def train_spn(self, step):
         # to train the semantic predictive network
         self.model.train()
+        prefetcher = None
+        if self.args.prefetch_batches > 0:
+            prefetcher = BatchPrefetcher(self.bmanager.spc_buffer, self.bsize, self.args.num_train_steps,
+                                         num_prefetch=self.args.prefetch_batches, num_workers=self.args.prefetch_workers)
         for ep in range(self.args.num_train_steps):
             self.optim.zero_grad()
-            pred_loss = self.train_model(self.args, ep+step)
-            guide_loss = self.train_guide_action(ep+step)
+            target = prefetcher.next() if prefetcher is not None else None
+            # the forward pass runs under autocast with --amp, the losses in FP32 (see one_loss)
+            with amp_autocast(self.args):
+                pred_loss = self.train_model(self.args, ep+step, target)
+                guide_loss = self.train_guide_action(ep+step)
             loss = pred_loss + guide_loss
             try:
                 print('loss = %0.4f\n' % loss.data.cpu().numpy())
             except:
                 print('loss = %0.4f\n' % loss)
-            loss.backward()
-            self.optim.step()
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optim)
+            self.scaler.update()
             self.epoch += 1
+        if prefetcher is not None:
+            prefetcher.close()
+        self.bmanager.feature_cache.invalidate()
 
         if self.epoch % self.args.save_freq == 0:
             self.save(step)
@@ -307,13 +345,15 @@ class Trainer():
         for step in range(self.num_steps, self.max_steps):
             obs_var = self.bmanager.store_frame(obs, info)
             self.model.eval()
-            action, guide_action = self.amanager.sample_action(net=self.model, obs=obs, obs_var=obs_var,action_var=action_var, exploration=self.exploration, step=step, explore=num_episode % 2)
+            action, guide_action = self.amanager.sample_action(net=self.model, obs=obs, obs_var=obs_var,action_var=action_var, exploration=self.exploration, step=step, explore=num_episode % 2, feature_cache=self.bmanager.feature_cache)
 
             obs, reward, done, info = self.env.step(action)
             action_var = self.bmanager.store_effect(guide_action, action, reward, done, info)
             
             total_reward += reward
             self.logstream(info, reward, total_reward, action, step)
+            for key, value in self.amanager.plan_stats.items():
+                self.logger.write(step, key, value)
 
             if self.bmanager.spc_buffer.can_sample(self.bsize) \
                 and self.args.sync and step % self.args.learning_freq == 0:
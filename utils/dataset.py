@@ -11,6 +11,7 @@ import math
 
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 
 
 def get_mean_and_std(dataset, max_load=10000):
@@ -198,12 +199,73 @@ def box_nms(bboxes, scores, threshold=0.5, mode='union'):
         else:
             raise TypeError('Unknown nms mode: %s.' % mode)
 
-        ids = (ovr<=threshold).nonzero().squeeze()
+        ids = (ovr<=threshold).nonzero().view(-1)
         if ids.numel() == 0:
             break
         order = order[ids+1]
     return torch.LongTensor(keep)
 
+def box_nms_batched(bboxes, scores, valid, threshold=0.5, mode='union', block_size=256, max_elements=2**25):
+    '''Non maximum suppression on a batch of padded box sets, without a per-box Python loop.
+
+    Gives the same result as running `box_nms` on each set. Boxes are settled block by block
+    in score order: a box survives iff no kept higher-scored box overlaps it, which inside a
+    block is iterated to its fixed point on the block x block iou matrix.
+
+    Args:
+      bboxes: (tensor) bounding boxes, sized [N,K,4].
+      scores: (tensor) bbox scores, sized [N,K].
+      valid: (tensor) mask of the non-padded boxes, sized [N,K].
+      threshold: (float) overlap threshold.
+      mode: (str) 'union' or 'min'.
+      block_size: (int) number of boxes settled together.
+      max_elements: (int) sets are processed in chunks of about this many iou entries.
+
+    Returns:
+      keep: (tensor) mask of the selected boxes, sized [N,K].
+    '''
+    if mode not in ('union', 'min'):
+        raise TypeError('Unknown nms mode: %s.' % mode)
+    N, K = scores.shape
+    keep = torch.zeros_like(valid)
+    if K == 0:
+        return keep
+    chunk = max(1, max_elements // (K * min(K, block_size)))
+    for start in range(0, N, chunk):
+        end = min(start + chunk, N)
+        _, order = scores[start:end].masked_fill(~valid[start:end], -float('inf')).sort(1, descending=True)
+        boxes = torch.gather(bboxes[start:end], 1, order.unsqueeze(-1).expand(-1, -1, 4))
+        is_valid = torch.gather(valid[start:end], 1, order)
+        x1, y1, x2, y2 = boxes[...,0], boxes[...,1], boxes[...,2], boxes[...,3]
+        areas = (x2-x1+1) * (y2-y1+1)
+
+        sorted_keep = torch.zeros_like(is_valid)
+        for bstart in range(0, K, block_size):
+            bend = min(bstart + block_size, K)
+            # overlap of every higher-or-equal scored box (rows) with the boxes of this block (columns)
+            w = (torch.min(x2[:,:bend,None], x2[:,None,bstart:bend]) - torch.max(x1[:,:bend,None], x1[:,None,bstart:bend]) + 1).clamp(min=0)
+            h = (torch.min(y2[:,:bend,None], y2[:,None,bstart:bend]) - torch.max(y1[:,:bend,None], y1[:,None,bstart:bend]) + 1).clamp(min=0)
+            inter = w*h  # [n,bend,B]
+            if mode == 'union':
+                ovr = inter / (areas[:,:bend,None] + areas[:,None,bstart:bend] - inter)
+            else:
+                ovr = inter / torch.min(areas[:,:bend,None], areas[:,None,bstart:bend])
+            suppress = ovr > threshold
+
+            # drop the boxes suppressed by kept boxes of the earlier blocks
+            cand = is_valid[:, bstart:bend] & ~(suppress[:, :bstart] & sorted_keep[:, :bstart, None]).any(1)
+            # suppression among the block itself, only higher-scored boxes count
+            block = suppress[:, bstart:bend].triu(diagonal=1) & is_valid[:, bstart:bend, None]
+            block_keep = cand
+            for _ in range(bend - bstart):
+                new_keep = cand & ~(block & block_keep[:,:,None]).any(1)
+                if torch.equal(new_keep, block_keep):
+                    break
+                block_keep = new_keep
+            sorted_keep[:, bstart:bend] = block_keep
+        keep[start:end].scatter_(1, order, sorted_keep)
+    return keep
+
 def softmax(x):
     '''Softmax along a specific dimension.
 
@@ -331,12 +393,16 @@ def format_time(seconds):
 
 
 class DataEncoder:
+    # number of (input size, device) anchor tensors kept around
+    anchor_cache_size = 8
+
     def __init__(self):
         # self.anchor_areas = [32*32., 64*64., 128*128., 256*256., 512*512.]  # p3 -> p7
         self.anchor_areas = [16*16., 32*32., 64*64., 128*128., 256*256.] # p2 -> p6
         self.aspect_ratios = [1/2., 1/1., 2/1.]
         self.scale_ratios = [1., pow(2,1/3.), pow(2,2/3.)]
         self.anchor_wh = self._get_anchor_wh()
+        self._anchor_cache = OrderedDict()
 
     def _get_anchor_wh(self):
         '''Compute anchor width and height for each feature map.
@@ -356,7 +422,33 @@ class DataEncoder:
         num_fms = len(self.anchor_areas)
         return torch.Tensor(anchor_wh).view(num_fms, -1, 2)
 
-    def _get_anchor_boxes(self, input_size):
+    def _get_anchor_boxes(self, input_size, device=None):
+        '''Get the (memoized) anchor boxes for each feature map.
+
+        The result is shared between calls, do not modify it in place.
+
+        Args:
+          input_size: (tensor) model input size of (w,h).
+          device: (torch.device) device to put the anchors on, CPU by default.
+
+        Returns:
+          boxes: (tensor) anchor boxes of all feature maps, sized [#anchors,4],
+                        where #anchors = sum(fmw * fmh * #anchors_per_cell)
+        '''
+        key = (tuple(float(v) for v in input_size), str(torch.device('cpu') if device is None else torch.device(device)))
+        if key in self._anchor_cache:
+            self._anchor_cache.move_to_end(key)
+            return self._anchor_cache[key]
+        if device is None or torch.device(device).type == 'cpu':
+            boxes = self._compute_anchor_boxes(torch.Tensor([float(v) for v in input_size]))
+        else:
+            boxes = self._get_anchor_boxes(input_size).to(device)
+        self._anchor_cache[key] = boxes
+        if len(self._anchor_cache) > self.anchor_cache_size:
+            self._anchor_cache.popitem(last=False)
+        return boxes
+
+    def _compute_anchor_boxes(self, input_size):
         '''Compute anchor boxes for each feature map.
 
         Args:
@@ -401,8 +493,7 @@ class DataEncoder:
           cls_targets: (tensor) encoded class labels, sized [#anchors,].
         '''
         # import pdb; pdb.set_trace()
-        input_size = torch.Tensor([input_size,input_size]) if isinstance(input_size, int) \
-                     else torch.Tensor(input_size)
+        input_size = (input_size, input_size) if isinstance(input_size, int) else input_size
         anchor_boxes = self._get_anchor_boxes(input_size)
         boxes = change_box_order(boxes, 'xyxy2xywh')
 
@@ -438,8 +529,7 @@ class DataEncoder:
         CLS_THRESH = 0.5
         NMS_THRESH = 0.5
 
-        input_size = torch.Tensor([input_size,input_size]) if isinstance(input_size, int) \
-                     else torch.Tensor(input_size)
+        input_size = (input_size, input_size) if isinstance(input_size, int) else input_size
         anchor_boxes = self._get_anchor_boxes(input_size)
 
         loc_xy = loc_preds[:,:2]
@@ -465,3 +555,134 @@ class DataEncoder:
         return res_boxes, res_labels, res_scores
 
         # return boxes[ids][keep], labels[ids][keep]
+
+    def encode_many(self, boxes, labels, colls_with, num_boxes, input_size, chunk_size=64):
+        '''Encode the target boxes of a whole stack of frames at once.
+
+        Same box coder as `encode`, frames without any box get loc 0, cls -1 and colls_with -1
+        (i.e. all anchors ignored), which is how SPCBuffer treats empty frames.
+
+        Args:
+          boxes: (tensor) padded bounding boxes of (xmin,ymin,xmax,ymax), sized [..., #max_obj, 4].
+          labels: (tensor) padded object class labels, sized [..., #max_obj].
+          colls_with: (tensor) padded whether-collide-with labels, sized [..., #max_obj].
+          num_boxes: (tensor) number of valid boxes of each frame, sized [...].
+          input_size: (int/tuple) model input size of (w,h).
+          chunk_size: (int) frames matched per step, bounds the [frames, #anchors, #max_obj] iou tensor.
+
+        Returns:
+          loc_targets: (tensor) encoded bounding boxes, sized [..., #anchors, 4].
+          cls_targets: (tensor) encoded class labels, sized [..., #anchors].
+          colls_with: (tensor) encoded whether-collide-with labels, sized [..., #anchors].
+        '''
+        input_size = (input_size, input_size) if isinstance(input_size, int) else input_size
+        anchor_boxes = self._get_anchor_boxes(input_size, boxes.device)  # [A,4]
+        frame_shape = num_boxes.shape
+        max_obj = boxes.size(-2)
+        num_anchors = anchor_boxes.size(0)
+
+        boxes = boxes.reshape(-1, max_obj, 4).float()
+        labels = labels.reshape(-1, max_obj)
+        colls_with = colls_with.reshape(-1, max_obj)
+        num_boxes = num_boxes.reshape(-1)
+        num_frames = boxes.size(0)
+
+        loc_targets = boxes.new_zeros(num_frames, num_anchors, 4)
+        cls_targets = labels.new_full((num_frames, num_anchors), -1)
+        colls_targets = colls_with.new_full((num_frames, num_anchors), -1)
+        if max_obj == 0:
+            return loc_targets.view(frame_shape + (num_anchors, 4)), cls_targets.view(frame_shape + (num_anchors,)), colls_targets.view(frame_shape + (num_anchors,))
+
+        # same rounding as box_iou(..., order='xywh') in `encode`
+        boxes_xywh = change_box_order(boxes.view(-1, 4), 'xyxy2xywh').view(num_frames, max_obj, 4)
+        boxes_xyxy = change_box_order(boxes_xywh.view(-1, 4), 'xywh2xyxy').view(num_frames, max_obj, 4)
+        anchors_xyxy = change_box_order(anchor_boxes, 'xywh2xyxy')
+        anchor_area = (anchors_xyxy[:,2]-anchors_xyxy[:,0]+1) * (anchors_xyxy[:,3]-anchors_xyxy[:,1]+1)  # [A,]
+        box_area = (boxes_xyxy[:,:,2]-boxes_xyxy[:,:,0]+1) * (boxes_xyxy[:,:,3]-boxes_xyxy[:,:,1]+1)  # [N,M]
+        valid = torch.arange(max_obj, device=boxes.device)[None, :] < num_boxes[:, None].to(boxes.device)  # [N,M]
+
+        for start in range(0, num_frames, chunk_size):
+            end = min(start + chunk_size, num_frames)
+            b = boxes_xyxy[start:end]
+            lt = torch.max(anchors_xyxy[None,:,None,:2], b[:,None,:,:2])  # [n,A,M,2]
+            rb = torch.min(anchors_xyxy[None,:,None,2:], b[:,None,:,2:])  # [n,A,M,2]
+            wh = (rb-lt+1).clamp(min=0)
+            inter = wh[...,0] * wh[...,1]  # [n,A,M]
+            ious = inter / (anchor_area[None,:,None] + box_area[start:end,None,:] - inter)
+            # padded boxes never match
+            ious = ious.masked_fill(~valid[start:end,None,:], -1)
+            max_ious, max_ids = ious.max(2)  # [n,A]
+
+            matched = torch.gather(boxes_xywh[start:end], 1, max_ids.unsqueeze(-1).expand(-1, -1, 4))  # [n,A,4]
+            loc_xy = (matched[...,:2]-anchor_boxes[None,:,:2]) / anchor_boxes[None,:,2:]
+            loc_wh = torch.log(matched[...,2:]/anchor_boxes[None,:,2:])
+            cls = 1 + torch.gather(labels[start:end], 1, max_ids)
+            colls = torch.gather(colls_with[start:end], 1, max_ids)
+
+            cls[max_ious<0.5] = 0
+            colls[max_ious<0.5] = 0
+            cls[(max_ious>0.4) & (max_ious<0.5)] = -1
+
+            nonempty = num_boxes[start:end] > 0
+            loc_targets[start:end][nonempty] = torch.cat([loc_xy, loc_wh], 2)[nonempty]
+            cls_targets[start:end][nonempty] = cls[nonempty]
+            colls_targets[start:end][nonempty] = colls[nonempty]
+
+        return loc_targets.view(frame_shape + (num_anchors, 4)), cls_targets.view(frame_shape + (num_anchors,)), colls_targets.view(frame_shape + (num_anchors,))
+
+    def decode_many(self, loc_preds, cls_preds, input_size, max_candidates=None):
+        '''Decode the outputs of a whole stack of frames into padded boxes.
+
+        Everything, NMS included, runs batched on the device of the predictions.
+
+        Args:
+          loc_preds: (tensor) predicted locations, sized [..., #anchors, 4].
+          cls_preds: (tensor) predicted class labels, sized [..., #anchors, #classes].
+          input_size: (int/tuple) model input size of (w,h).
+          max_candidates: (int) if set, only the top scored candidates of each frame go into NMS.
+
+        Returns:
+          boxes: (tensor) decoded box locations, sized [..., #max_obj, 4], zero padded.
+          labels: (tensor) class labels for each box, sized [..., #max_obj], padded with -1.
+          scores: (tensor) score of each box, sized [..., #max_obj], padded with 0.
+          num_boxes: (tensor) number of kept boxes of each frame, sized [...].
+        '''
+        CLS_THRESH = 0.5
+        NMS_THRESH = 0.5
+
+        input_size = (input_size, input_size) if isinstance(input_size, int) else input_size
+        anchor_boxes = self._get_anchor_boxes(input_size, loc_preds.device)
+        frame_shape = loc_preds.shape[:-2]
+        num_anchors = anchor_boxes.size(0)
+        loc_preds = loc_preds.reshape(-1, num_anchors, 4)
+        cls_preds = cls_preds.reshape(-1, num_anchors, cls_preds.size(-1))
+        num_frames = loc_preds.size(0)
+
+        xy = loc_preds[...,:2] * anchor_boxes[:,2:] + anchor_boxes[:,:2]
+        wh = loc_preds[...,2:].exp() * anchor_boxes[:,2:]
+        boxes = torch.cat([xy-wh/2, xy+wh/2], -1)  # [N,#anchors,4]
+        score, labels = cls_preds.sigmoid().max(-1)  # [N,#anchors]
+
+        # candidates above the score threshold, sorted by score and padded to the busiest frame
+        is_cand = score > CLS_THRESH
+        num_cand = int(is_cand.sum(1).max()) if num_frames > 0 else 0
+        if max_candidates is not None:
+            num_cand = min(num_cand, max_candidates)
+        cand_score, cand_ids = score.masked_fill(~is_cand, -1).topk(num_cand, dim=1)
+        cand_valid = cand_score > CLS_THRESH
+        cand_boxes = torch.gather(boxes, 1, cand_ids.unsqueeze(-1).expand(-1, -1, 4))
+        cand_labels = torch.gather(labels, 1, cand_ids)
+        keep = box_nms_batched(cand_boxes, cand_score, cand_valid, threshold=NMS_THRESH)
+
+        # compact the kept boxes to the front, keeping the score order
+        num_boxes = keep.sum(1)
+        max_obj = int(num_boxes.max()) if num_frames > 0 else 0
+        pos = (keep.long().cumsum(1) - 1).masked_fill(~keep, max_obj)
+        res_boxes = boxes.new_zeros(num_frames, max_obj + 1, 4).scatter_(1, pos.unsqueeze(-1).expand(-1, -1, 4), cand_boxes)
+        res_labels = labels.new_full((num_frames, max_obj + 1), -1).scatter_(1, pos, cand_labels)
+        res_scores = score.new_zeros(num_frames, max_obj + 1).scatter_(1, pos, cand_score)
+        # the extra column collected the dropped candidates
+        res_boxes, res_labels, res_scores = res_boxes[:, :max_obj], res_labels[:, :max_obj], res_scores[:, :max_obj]
+
+        return res_boxes.reshape(frame_shape + (max_obj, 4)), res_labels.reshape(frame_shape + (max_obj,)), \
+            res_scores.reshape(frame_shape + (max_obj,)), num_boxes.reshape(frame_shape)
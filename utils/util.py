@@ -303,7 +303,7 @@ def load_model(args, path, net, resume=True):
         if args.checkpoint != "" and args.eval:
             # evaluation mode, loading specified checkpoint
             model_path = args.checkpoint
-            state_dict = torch.load(model_path)
+            state_dict = torch.load(model_path, map_location='cpu')
             net.load_state_dict(state_dict)
             print("eval | loaded model: {}".format(args.checkpoint))
             epoch, step = 0
@@ -322,7 +322,7 @@ def load_model(args, path, net, resume=True):
             if len(file_list) == 0 and not args.eval:
                 print('No model to resume!')
                 model_path = args.pretrain_model
-                state_dict = torch.load(model_path)
+                state_dict = torch.load(model_path, map_location='cpu')
                 print('turn to the base pretrain model: {}'.format(args.pretrain_model))
                 net.load_state_dict(state_dict)
                 epoch, step = 0, 0
@@ -330,13 +330,13 @@ def load_model(args, path, net, resume=True):
                 model_path = file_list[-1]
                 epoch = pkl.load(open(os.path.join(path, 'epoch.pkl'), 'rb'))
                 print('Loading model from', os.path.join(path, 'model', model_path))
-                state_dict = torch.load(os.path.join(path, 'model', model_path))
+                state_dict = torch.load(os.path.join(path, 'model', model_path), map_location='cpu')
                 step = int(model_path.split("_")[-1].split(".")[0])
                 net.load_state_dict(state_dict)
     else:
         print('Start from scratch!')
         model_path = args.pretrain_model
-        state_dict = torch.load(model_path)
+        state_dict = torch.load(model_path, map_location='cpu')
         print('turn to the base pretrain model: {}'.format(args.pretrain_model))
         net.load_state_dict(state_dict)
         epoch, step = 0, 0 
@@ -345,22 +345,57 @@ def load_model(args, path, net, resume=True):
 
 
 def from_variable_to_numpy(x):
-    x = x.data
-    if torch.cuda.is_available():
-        x = x.cpu()
-    x = x.numpy()
+    x = x.data.cpu().numpy()
     return x
 
 
+def amp_autocast(args, enabled=True):
+    # the autocast region of --amp on args.device, a no-op context with --amp off
+    dtype = torch.float16 if args.amp == 'fp16' else torch.bfloat16
+    return torch.autocast(args.device, dtype=dtype, enabled=enabled and args.amp != 'off')
+
+
 def tile_single(x, action):
     batch_size, c, w, h = x.size()
     assert action.size(0) == batch_size
-    action = action.view(action.size(0), -1, 1, 1).repeat(1, 1, w, h)
+    action = action.to(x.dtype).view(action.size(0), -1, 1, 1).repeat(1, 1, w, h)
     return torch.cat([x, action], dim=1)
 
 
+class TiledFeature(object):
+    '''
+    A feature map with an action tiled onto it as constant channels, kept unconcatenated.
+    The ConvLSTM cells read the action part as a per-sample bias, so a feature of batch size 1 can be
+    shared by a batch of actions without copying it (see convLSTMCell). materialize() gives tile_single's tensor.
+    '''
+    def __init__(self, feature, action):
+        assert feature.size(0) in (1, action.size(0))
+        self.feature = feature
+        self.action = action
+
+    def size(self, dim=None):
+        size = torch.Size([self.action.size(0), self.feature.size(1) + self.action.size(1)]) + self.feature.size()[2:]
+        return size if dim is None else size[dim]
+
+    def materialize(self):
+        feature = self.feature.expand(self.action.size(0), *self.feature.size()[1:])
+        return tile_single(feature, self.action)
+
+
+def take_batch(x, index, batch_size):
+    # the samples index of the batch_size batch of x: a tensor, TiledFeature or (nested) list / tuple of them;
+    # tensors of batch size 1 are shared by the whole batch and kept as they are
+    if x is None:
+        return None
+    if isinstance(x, (list, tuple)):
+        return type(x)(take_batch(t, index, batch_size) for t in x)
+    if isinstance(x, TiledFeature):
+        return TiledFeature(take_batch(x.feature, index, batch_size), x.action[index])
+    return x[index] if x.size(0) == batch_size else x
+
+
 def tile(x, action):
-    return list(map(lambda t: tile_single(t, action), x))
+    return list(map(lambda t: TiledFeature(t, action), x))
 
 
 def tile_first(x, action):